@@ -0,0 +1,97 @@
+"""Measure eye-crop inference throughput of the hourglass presets (untrained weights).
+
+Every preset is measured with the placeholder-fed `CNN.predict` path and with the old
+per-frame iterator path, to report the per-crop latency saved, and with
+`CNN.predict_eyes`, which only fetches the landmarks, radius and heatmap peaks. Every
+preset is first checked to return landmarks in eye crop coordinates.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+
+from data_sources.img_data_source import ImgDataSource
+from models.cnn import CNN, MODEL_CONFIGS
+
+parser = argparse.ArgumentParser(description='Benchmark inference of the hourglass presets.')
+parser.add_argument('--model-configs', type=str, nargs='+', default=sorted(MODEL_CONFIGS))
+parser.add_argument('--eye-shape', type=int, nargs='+', default=[60, 90])
+parser.add_argument('--data-format', type=str, default='NHWC')
+parser.add_argument('--precision', type=str, default='float32')
+parser.add_argument('--exit-module', type=int, default=None)
+parser.add_argument('--adaptive-exit', action='store_true')
+parser.add_argument('--benchmark-crops', type=int, default=200)
+parser.add_argument('--warmup-crops', type=int, default=20)
+
+
+def check_landmark_scale(sess, model, eye_shape, data_format):
+    """Landmarks of every exit must be in eye crop coordinates, also with a strided first
+    layer: a heatmap peak in the last pixel is a landmark near the last crop pixel."""
+    height, width = eye_shape
+    for i, outputs in enumerate(model.exits):
+        shape = outputs['heatmaps'].shape.as_list()
+        heatmaps = np.zeros([1] + shape[1:], dtype=outputs['heatmaps'].dtype.as_numpy_dtype)
+        if data_format == 'NHWC':
+            heatmaps[0, -1, -1, :] = 1.0
+        else:
+            heatmaps[0, :, -1, -1] = 1.0
+        landmarks = sess.run(outputs['landmarks'], feed_dict={outputs['heatmaps']: heatmaps})
+        assert np.all(np.abs(landmarks[0] - [width, height]) <= 1.0), (
+            'exit %d landmarks are not in eye crop coordinates: %s' % (i + 1, landmarks[0, 0]))
+
+
+def benchmark(args, model_config, use_iterator=False, confidence_only=False):
+    """Eye crops/s fed directly with `CNN.predict` (`CNN.predict_eyes` with
+    `confidence_only`) or, with `use_iterator`, through the per-frame iterator,
+    training flag assignment and `CNN.run_model`."""
+    with tf.Graph().as_default():
+        datasource = ImgDataSource(shape=tuple(args.eye_shape), data_format=args.data_format,
+                                   use_iterator=use_iterator)
+        model = CNN(datasource.tensors, datasource.x_shape, None, data_format=args.data_format,
+                    predict_only=True, precision=args.precision, model_config=model_config)
+        datasource.image = np.random.uniform(-1.0, 1.0, datasource.shape).astype(np.float32)
+
+        with tf.Session() as sess:
+            sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+            check_landmark_scale(sess, model, args.eye_shape, args.data_format)
+
+            def run_crop():
+                if use_iterator:
+                    datasource.run_single(sess)
+                    model.eval(sess)
+                    model.run_model(sess, args.exit_module, args.adaptive_exit)
+                elif confidence_only:
+                    model.predict_eyes(sess, datasource.feed_dict(datasource.image),
+                                       exit_module=args.exit_module,
+                                       adaptive_exit=args.adaptive_exit)
+                else:
+                    model.predict(sess, datasource.feed_dict(datasource.image),
+                                  args.exit_module, args.adaptive_exit)
+
+            for _ in range(args.warmup_crops):
+                run_crop()
+
+            t = time.time()
+            for _ in range(args.benchmark_crops):
+                run_crop()
+            return args.benchmark_crops / (time.time() - t)
+
+
+def main(args):
+    for model_config in args.model_configs:
+        iterator = benchmark(args, model_config, use_iterator=True)
+        direct = benchmark(args, model_config)
+        print('%s: %.1f eye crops/s (%.2fms per crop), %.1f with the per-frame iterator '
+              '(%.2fms per crop), %.2fx speedup' % (model_config, direct, 1e3 / direct,
+                                                     iterator, 1e3 / iterator,
+                                                     direct / iterator))
+        confidence = benchmark(args, model_config, confidence_only=True)
+        print('%s: %.1f eye crops/s (%.2fms per crop) fetching only landmarks, radius and '
+              'heatmap peaks' % (model_config, confidence, 1e3 / confidence))
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
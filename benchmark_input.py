@@ -0,0 +1,37 @@
+"""Measure the throughput of the training input pipeline on its own (no model)."""
+
+from __future__ import division, print_function, absolute_import
+
+import time
+import tensorflow as tf
+
+from train_cnn import parser, get_datasource
+
+parser.description = 'Benchmark the input pipeline used by train_cnn.py.'
+parser.add_argument('--benchmark-batches', type=int, default=200)
+parser.add_argument('--warmup-batches', type=int, default=20)
+
+
+def main(args):
+    datasource = get_datasource(args)
+    # Run the whole pipeline without copying the batch back to Python
+    next_batch = tf.group(*datasource.tensors)
+
+    with tf.Session() as sess:
+        datasource.train.run(sess)
+        for _ in range(args.warmup_batches):
+            sess.run(next_batch)
+
+        t = time.time()
+        for _ in range(args.benchmark_batches):
+            sess.run(next_batch)
+        elapsed = time.time() - t
+
+    num_samples = args.benchmark_batches * args.batch_size
+    print('%d batches (%d samples) in %.2fs: %.1f batches/s, %.1f samples/s' % (
+        args.benchmark_batches, num_samples, elapsed,
+        args.benchmark_batches / elapsed, num_samples / elapsed))
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,70 @@
+"""Measure training steps/s with summaries fetched every step versus every --summary-steps.
+
+With --data-parallel-workers N the scaling efficiency of data-parallel training is
+reported as well, relative to N times the single process throughput.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import time
+import tensorflow as tf
+
+import functools
+
+from learning.data_parallel import DataParallelTrainer
+from train_cnn import (parser, get_datasource, get_model, build_data_parallel_model,
+                       check_data_parallel_args)
+
+parser.description = 'Benchmark the training loop used by train_cnn.py.'
+parser.add_argument('--benchmark-steps', type=int, default=200)
+parser.add_argument('--warmup-steps', type=int, default=20)
+
+
+def run_steps(sess, model, num_steps, summary_steps):
+    t = time.time()
+    for step in range(num_steps):
+        summary, _, _ = model.train_iteration(sess, with_summaries=step % summary_steps == 0)
+        if summary is not None:
+            model.train_writer.add_summary(summary, step)
+    return num_steps / (time.time() - t)
+
+
+def main(args):
+    # The single process baseline only differs from the workers by data_parallel
+    if args.data_parallel_workers > 1:
+        check_data_parallel_args(args)
+    datasource = get_datasource(args)
+    model = get_model(args, datasource)
+
+    with tf.Session() as sess:
+        sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+        datasource.train.run(sess)
+        model.train(sess)
+        run_steps(sess, model, args.warmup_steps, 1)
+
+        every_step = run_steps(sess, model, args.benchmark_steps, 1)
+        throttled = run_steps(sess, model, args.benchmark_steps, args.summary_steps)
+
+    print('summaries every step: %.2f steps/s' % every_step)
+    print('summaries every %d steps: %.2f steps/s (%+.1f%%)' % (
+        args.summary_steps, throttled, 100.0 * (throttled / every_step - 1.0)))
+
+    if args.data_parallel_workers > 1:
+        single = throttled * args.batch_size
+        trainer = DataParallelTrainer(functools.partial(build_data_parallel_model, args),
+                                      args.data_parallel_workers,
+                                      eval_steps=args.benchmark_steps + 1,
+                                      log_steps=args.benchmark_steps + 1,
+                                      summary_steps=args.summary_steps,
+                                      checkpoint_steps=args.benchmark_steps + 1,
+                                      checkpoint_secs=float('inf'), resume=False)
+        parallel = trainer.run_training(args.benchmark_steps + 1,
+                                        output_path='checkpoints/benchmark_cnn.ckpt')
+        print('single process: %.1f samples/s, %d workers: %.1f samples/s, '
+              'scaling efficiency %.1f%%' % (
+                  single, args.data_parallel_workers, parallel,
+                  100.0 * parallel / (args.data_parallel_workers * single)))
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -17,22 +17,9 @@ from webcam.webcam_stream import WebcamVideoStream
 
 from data_sources.img_data_source import ImgDataSource
 from preprocessing.img_preprocessor import ImgPreprocessor
-from models.cnn import CNN
-
-
-# Function for creating landmark coordinate list
-def land2coords(landmarks, dtype="int"):
-    # initialize the list of tuples
-    # (x, y)-coordinates
-    coords = np.zeros((68, 2), dtype=dtype)
-
-    # loop over the eyes landmarks and convert them
-    # to a 2-tuple of (a, b)-coordinates
-    for i in range(36, 48):
-        coords[i] = (landmarks.part(i).x, landmarks.part(i).y)
-
-    # return the list of (a, b)-coordinates
-    return coords
+from models.cnn import CNN, load_model_config
+from util.face_tracker import shape_to_coords
+from util.gaze import landmark_confidence
 
 
 def get_eye_info(args, landmarks, frame_gray):
@@ -97,12 +84,9 @@ def get_eye_info(args, landmarks, frame_gray):
     return eyes
 
 
-def estimate_gaze(gaze_history, eye, heatmaps, face_landmarks, eye_landmarks, eye_radius, face, frame_rgb):
+def estimate_gaze(gaze_history, eye, heatmaps_amax, face_landmarks, eye_landmarks, eye_radius, face, frame_rgb):
     # Gaze estimation
-    heatmaps_amax = np.amax(heatmaps.reshape(-1, 18), axis=0)
-    can_use_eye = np.all(heatmaps_amax > 0.7)
-    can_use_eyelid = np.all(heatmaps_amax[0:8] > 0.75)
-    can_use_iris = np.all(heatmaps_amax[8:16] > 0.8)
+    can_use_eye, can_use_eyelid, can_use_iris = landmark_confidence(heatmaps_amax)
     bgr = frame_rgb
     # bgr = cv2.flip(bgr, flipCode=1)
     eye_image = eye['image']
@@ -211,14 +195,7 @@ def estimate_gaze(gaze_history, eye, heatmaps, face_landmarks, eye_landmarks, ey
 
 def detect_eye_landmarks(image_np, datasource, preprocessor, sess, model):
     preprocessed_image = preprocessor.preprocess_entry(image_np)
-    datasource.image = preprocessed_image
-    datasource.run_single(sess)
-    model.eval(sess)
-    input_image, eye_landmarks, eye_heatmaps, eye_radius = model.run_model(
-        sess)
-    assert np.all(input_image == preprocessed_image), (input_image,
-                                                       preprocessed_image)
-    return eye_landmarks, eye_heatmaps, eye_radius
+    return model.predict_eyes(sess, datasource.feed_dict(preprocessed_image))
 
 
 def setup(args):
@@ -231,7 +208,8 @@ def setup(args):
                                data_format=data_format)
     # Get model
     model = CNN(datasource.tensors, datasource.x_shape, None,
-                data_format=data_format, predict_only=True)
+                data_format=data_format, predict_only=True,
+                model_config=load_model_config(args.model_checkpoint))
 
     # Start session
     saver = tf.train.Saver()
@@ -313,15 +291,15 @@ class Model:
         # Let's predict the landmarks
         landmarks = self.landmark_predictor(frame_gray, face)
         # converting co-ordinates to NumPy array
-        landmarks = land2coords(landmarks)
+        landmarks = shape_to_coords(landmarks)
 
         eyes = get_eye_info(self.args, landmarks, frame_gray)
         face = (face.left(), face.top(), face.right(), face.bottom())
         for eye in eyes:
-            eye_landmarks, heatmaps, eye_radius = detect_eye_landmarks(eye['image'], self.datasource, self.preprocessor, self.sess, self.model)
-            eye_landmarks = eye_landmarks.reshape(18, 2)
+            outputs = detect_eye_landmarks(eye['image'], self.datasource, self.preprocessor, self.sess, self.model)
+            eye_landmarks = outputs['landmarks'].reshape(18, 2)
             bgr, self.gaze_history, gaze = estimate_gaze(
-                self.gaze_history, eye, heatmaps, landmarks, eye_landmarks, eye_radius, face, frame_rgb)
+                self.gaze_history, eye, outputs['heatmaps_amax'][0], landmarks, eye_landmarks, outputs['radius'], face, frame_rgb)
 
             for (a, b) in landmarks.reshape(-1, 2):
                 cv2.circle(frame, (a, b), 2, (0, 255, 0), -1)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Convert a directory of per-sample pickles into TFRecord shards or memory-mapped arrays."""
+
+import argparse
+import glob
+import os
+import time
+import numpy as np
+
+import util.util as util
+import util.records as records
+import util.arrays as arrays
+from data_sources.data_source import HEATMAP_KEYS, LANDMARK_KEYS
+
+parser = argparse.ArgumentParser(description='Convert pickles to TFRecord shards or memory-mapped arrays')
+parser.add_argument('--input-path', type=str, required=True)
+parser.add_argument('--output-path', type=str, required=True)
+parser.add_argument('--shard-size', type=int, default=1000)
+parser.add_argument('--output-format', type=str, default='tfrecord', choices=['tfrecord', 'mmap'],
+                    help='tfrecord (sharded) or mmap (one contiguous .npy array per key).')
+parser.add_argument('--seed', type=int, default=7,
+                    help='Seed used to shuffle samples when writing memory-mapped arrays.')
+
+
+def convert_to_tfrecord(files, args):
+    t = time.time()
+    num_records = {}
+    for shard_index, start in enumerate(range(0, len(files), args.shard_size)):
+        writer = records.ShardWriter(args.output_path, shard_index)
+        for filename in files[start:start + args.shard_size]:
+            writer.write(util.load_pickle(filename))
+        writer.close()
+        num_records[os.path.basename(writer.filename)] = writer.num_records
+        util.print_progress_bar(min(start + args.shard_size, len(files)), len(files),
+                                'shard %s' % writer.filename)
+
+    records.write_index(args.output_path, num_records)
+    print('converted %d pickles into %d shards in %.2fs' % (
+        len(files), len(num_records), time.time() - t))
+
+
+def convert_to_mmap(files, args):
+    t = time.time()
+    # Shuffle once here so that training can read contiguous batches
+    files = list(np.random.RandomState(args.seed).permutation(files))
+    example = util.load_pickle(files[0])
+    keys = HEATMAP_KEYS if 'heatmaps' in example else LANDMARK_KEYS
+    output = arrays.create_arrays(args.output_path, keys, len(files), example)
+    for index, filename in enumerate(files):
+        data = util.load_pickle(filename)
+        for key in keys:
+            output[key][index] = data[key]
+        if (index + 1) % args.shard_size == 0 or index + 1 == len(files):
+            util.print_progress_bar(index + 1, len(files), 'writing %s' % args.output_path)
+
+    for key in keys:
+        output[key].flush()
+    print('converted %d pickles into memory-mapped arrays in %.2fs' % (
+        len(files), time.time() - t))
+
+
+def main(args):
+    util.mkdir(args.output_path)
+    files = sorted(glob.glob(os.path.join(args.input_path, '*.pickle')))
+
+    if args.output_format == 'tfrecord':
+        convert_to_tfrecord(files, args)
+    else:
+        convert_to_mmap(files, args)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -3,6 +3,72 @@ import numpy as np
 import tensorflow as tf
 import time
 import pickle
+import multiprocessing
+
+import util.records as records
+import util.heatmap as heatmap
+import util.arrays as arrays
+
+# Tensors read for each sample when heatmaps are stored or rendered from landmarks
+HEATMAP_KEYS = ('eye', 'heatmaps', 'landmarks', 'radius')
+LANDMARK_KEYS = ('eye', 'landmarks', 'radius', 'heatmap_sigma')
+
+
+def autotune(fallback):
+    """`tf.data` AUTOTUNE when this TensorFlow version supports it, `fallback` otherwise."""
+    return getattr(getattr(tf.data, 'experimental', None), 'AUTOTUNE', fallback)
+
+
+def data_shapes(shape, heatmap_scale, data_format):
+    """Per-sample shape of every tensor stored in a dataset."""
+    heatmaps_shape = [int(s * heatmap_scale) for s in shape]
+    if data_format == 'NHWC':
+        eye_shape, heatmaps_shape = list(shape) + [1], heatmaps_shape + [18]
+    else:
+        eye_shape, heatmaps_shape = [1] + list(shape), [18] + heatmaps_shape
+    return {
+        'eye': eye_shape,
+        'heatmaps': heatmaps_shape,
+        'landmarks': [18, 2],
+        'radius': [],
+        'heatmap_sigma': [],
+    }
+
+
+def add_heatmaps(eye, landmarks, radius, heatmap_sigma, shape, heatmap_scale, data_format,
+                 fixed_sigma=None):
+    """Render the heatmaps of a batch from its landmarks, returns the usual data tuple."""
+    if fixed_sigma is not None:
+        heatmap_sigma = tf.fill(tf.shape(radius), float(fixed_sigma))
+    heatmaps_shape = [int(s * heatmap_scale) for s in shape]
+    heatmaps = heatmap.tensorflow_gaussian_2d(heatmaps_shape, heatmap_scale * landmarks,
+                                              heatmap_sigma)
+    if data_format == 'NHWC':
+        heatmaps = tf.transpose(heatmaps, (0, 2, 3, 1))
+    return eye, heatmaps, landmarks, radius
+
+
+def augment_dataset(dataset, augmenter, first_batch=0):
+    """Augment batches of (eye, landmarks, radius, heatmap_sigma) with `augmenter` online.
+
+    Batches are numbered in the graph from `first_batch` (the batches skipped when
+    resuming) and augmented with the seeds of their number, so the result does not
+    depend on the order the parallel calls run in. The stored heatmap sigma is replaced
+    by the one of the augmentation difficulty.
+    """
+    def _augment(batch_index, batch):
+        eye, landmarks, radius, heatmap_sigma = batch
+        eye_out, landmarks_out, radius_out, heatmap_sigma_out = tf.py_func(
+            augmenter.augment_batch, [batch_index, eye, landmarks, radius], [tf.float32] * 4)
+        eye_out.set_shape(eye.shape)
+        landmarks_out.set_shape(landmarks.shape)
+        radius_out.set_shape(radius.shape)
+        heatmap_sigma_out.set_shape(heatmap_sigma.shape)
+        return eye_out, landmarks_out, radius_out, heatmap_sigma_out
+    batch_indices = tf.data.Dataset.range(first_batch, np.iinfo(np.int64).max)
+    return tf.data.Dataset.zip((batch_indices, dataset)).map(
+        _augment, num_parallel_calls=augmenter.num_parallel_calls)
+
 
 class DataSource(object):
     def __init__(self,
@@ -12,43 +78,138 @@ class DataSource(object):
                  seed=7,
                  shape=(150, 90),
                  heatmap_scale=0.5,
-                 data_format='NHWC'):
+                 data_format='NHWC',
+                 mmap=False,
+                 render_heatmaps=False,
+                 heatmap_sigma=None,
+                 augmenter=None,
+                 num_parallel_calls=None,
+                 num_parallel_reads=None,
+                 prefetch_batches=None,
+                 shard_index=0,
+                 num_shards=1):
         self.batch_size = batch_size
         self.data_format = data_format.upper()
         assert self.data_format == 'NHWC' or self.data_format == 'NCHW'
 
+        # With mmap=True train_files and eval_files are directories of .npy arrays
+        data_cls = MmapData if mmap else Data
+        data_kwargs = dict(batch_size=batch_size, data_format=data_format,
+                           heatmap_scale=heatmap_scale, shape=shape,
+                           render_heatmaps=render_heatmaps, heatmap_sigma=heatmap_sigma,
+                           num_parallel_calls=num_parallel_calls,
+                           num_parallel_reads=num_parallel_reads,
+                           prefetch_batches=prefetch_batches)
+
         if train_files is not None:
-            self.train = Data(train_files, batch_size=batch_size, data_format=data_format,
-                              heatmap_scale=heatmap_scale, shape=shape)
+            # Data-parallel workers train on disjoint shards, but all evaluate on everything
+            self.train = data_cls(train_files, augmenter=augmenter, shard_index=shard_index,
+                                  num_shards=num_shards, **data_kwargs)
        
         if eval_files is not None:
-            self.eval = Data(eval_files, batch_size=batch_size, data_format=data_format,
-                             heatmap_scale=heatmap_scale, shape=shape)
+            self.eval = data_cls(eval_files, **data_kwargs)
 
-        self.iter = tf.data.Iterator.from_structure(self.eval._dataset.output_types,
-                                                    self.eval._dataset.output_shapes)
+        # String handle of the active iterator, kept in a local variable (not saved in
+        # checkpoints) so that train and eval switch with a single assign
+        self.handle = tf.Variable('', dtype=tf.string, trainable=False, name='data_handle',
+                                  collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        self.iter = tf.data.Iterator.from_string_handle(self.handle,
+                                                        self.eval._dataset.output_types,
+                                                        self.eval._dataset.output_shapes)
         
         if train_files is not None:
-            self.train.make_initializer(self.iter)
+            self.train.make_initializer(self.handle)
         if eval_files is not None:
-            self.eval.make_initializer(self.iter)
+            self.eval.make_initializer(self.handle)
 
         self.x_shape = (36, 60)
         self.tensors = self.iter.get_next()
 
+    def close(self):
+        """Release the resources of the data backends (the online augmentation pool)."""
+        for data in (getattr(self, 'train', None), getattr(self, 'eval', None)):
+            if data is not None:
+                data.close()
+
+
+class BaseData(object):
+    """Persistent train and single pass iterators shared by the data backends.
+
+    The active iterator is selected by assigning its string handle to the
+    `DataSource.handle` variable, so switching between train and eval neither
+    re-initializes the train iterator nor drops its shuffle buffer and prefetched batches.
+    """
+    def make_initializer(self, handle):
+        self._iterator = self._dataset.make_initializable_iterator()
+        self._iterator_single = self._dataset_single.make_initializable_iterator()
+        self._select_op = tf.assign(handle, self._iterator.string_handle())
+        self._select_op_single = tf.assign(handle, self._iterator_single.string_handle())
+        self._initialized_session = None
+
+    def run(self, sess, skip_batches=0):
+        """Select the train iterator, `skip_batches` fast-forwards it when resuming.
 
-class Data(object):
+        Skipping is O(skipped batches): `Data` reads and decodes every skipped record
+        again, `MmapData` only replays the batch order.
+        """
+        # The (infinite) train iterator is only initialized once per session
+        if self._initialized_session is not sess:
+            sess.run(self._iterator.initializer, feed_dict=self._skip_feed(skip_batches))
+            self._initialized_session = sess
+        sess.run(self._select_op)
+
+    def run_single(self, sess):
+        sess.run(self._iterator_single.initializer)
+        sess.run(self._select_op_single)
+
+    def close(self):
+        augmenter = getattr(self, 'augmenter', None)
+        if augmenter is not None:
+            augmenter.close()
+
+    @property
+    def ids(self):
+        return self._ids
+
+    @property
+    def num_examples(self):
+        return self._num_examples
+
+
+class Data(BaseData):
     def __init__(self,
                  files,
                  batch_size=32,
                  shape=(150, 90),
                  heatmap_scale=0.5,
                  seed=7,
-                 data_format='NHWC'):
+                 data_format='NHWC',
+                 render_heatmaps=False,
+                 heatmap_sigma=None,
+                 augmenter=None,
+                 num_parallel_calls=None,
+                 num_parallel_reads=None,
+                 prefetch_batches=None,
+                 shard_index=0,
+                 num_shards=1):
         self.batch_size = batch_size
 
+        # Shard by files when there are enough of them, else by records
+        shard_records = num_shards > 1 and len(files) < num_shards
+        if num_shards > 1 and not shard_records:
+            files = files[shard_index::num_shards]
+
+        # Parallelism of decoding, of reading shards and number of batches prefetched
+        self._num_parallel_calls = num_parallel_calls or autotune(multiprocessing.cpu_count())
+        self._num_parallel_reads = num_parallel_reads or max(1, min(len(files),
+                                                                     multiprocessing.cpu_count()))
+        self._prefetch_batches = prefetch_batches or autotune(2)
+
         self._files = files
-        self._num_examples = len(files)
+        self._use_tfrecord = records.is_tfrecord(files)
+        self._num_examples = records.count_records(files) if self._use_tfrecord else len(files)
+        if shard_records:
+            self._num_examples = len(range(shard_index, self._num_examples, num_shards))
         self._ids = np.arange(self._num_examples)
         
         self.data_format = data_format.upper()
@@ -57,48 +218,175 @@ class Data(object):
         self._heatmap_scale = heatmap_scale
         self._shape = shape
 
-        base_dataset = tf.data.Dataset.from_tensor_slices(self._files)
+        # Render heatmaps from the landmarks after batching instead of reading them,
+        # heatmap_sigma overrides the sigma saved with each sample
+        self._render_heatmaps = render_heatmaps
+        self._heatmap_sigma = heatmap_sigma
+        self._keys = LANDMARK_KEYS if render_heatmaps else HEATMAP_KEYS
+
+        # Online augmentation moves landmarks, so heatmaps have to be rendered afterwards
+        assert augmenter is None or render_heatmaps
+        self.augmenter = augmenter
 
-        base_dataset = base_dataset.map(lambda filename: tuple(tf.py_func(
-            self._preprocess_pickle, [filename], [tf.float32, tf.float32, tf.float32, tf.float32])))
+        if self._use_tfrecord:
+            # Read shards concurrently (deterministic order) and decode in parallel
+            base_dataset = tf.data.Dataset.from_tensor_slices(self._files).apply(
+                tf.contrib.data.parallel_interleave(
+                    lambda filename: tf.data.TFRecordDataset(filename,
+                                                             buffer_size=8 * 1024 * 1024),
+                    cycle_length=self._num_parallel_reads))
+            if shard_records:
+                base_dataset = base_dataset.shard(num_shards, shard_index)
+            base_dataset = base_dataset.map(self._parse_record,
+                                            num_parallel_calls=self._num_parallel_calls)
+        else:
+            base_dataset = tf.data.Dataset.from_tensor_slices(self._files)
+            if shard_records:
+                base_dataset = base_dataset.shard(num_shards, shard_index)
+            base_dataset = base_dataset.map(lambda filename: tuple(tf.py_func(
+                self._preprocess_pickle, [filename], [tf.float32] * len(self._keys))),
+                num_parallel_calls=self._num_parallel_calls)
         base_dataset = base_dataset.map(self._set_shapes)
     
+        # The shuffle is seeded, so skipping samples reproduces the order of a previous run.
+        # Skipped samples are still read and decoded
+        self._skip_batches = tf.placeholder_with_default(tf.constant(0, tf.int64), [])
+
         self._dataset_single = base_dataset.cache().batch(self.batch_size)
         self._dataset = base_dataset.cache() \
                 .shuffle(10000, seed=seed) \
-                .repeat().batch(self.batch_size) \
-                .prefetch(2 * self.batch_size)
+                .repeat().skip(self._skip_batches * self.batch_size) \
+                .batch(self.batch_size)
+        if self.augmenter is not None:
+            self._dataset = augment_dataset(self._dataset, self.augmenter, self._skip_batches)
+        if self._render_heatmaps:
+            self._dataset_single = self._dataset_single.map(
+                self._add_heatmaps, num_parallel_calls=self._num_parallel_calls)
+            self._dataset = self._dataset.map(
+                self._add_heatmaps, num_parallel_calls=self._num_parallel_calls)
+        # Buffer size counts batches, since it is applied after batching
+        self._dataset = self._dataset.prefetch(self._prefetch_batches)
         
+    def _skip_feed(self, skip_batches):
+        return {self._skip_batches: skip_batches}
+
     def _preprocess_pickle(self, filename):
         data = pickle.load(open(filename, 'rb'))
-        return data['eye'], data['heatmaps'], data['landmarks'], data['radius']
-    
-    def _set_shapes(self, eye, heatmaps, landmarks, radius):
-        heatmaps_shape = [int(s * self._heatmap_scale) for s in self._shape]
-        if self.data_format == 'NHWC':
-            eye.set_shape(list(self._shape) + [1])
-            heatmaps.set_shape(heatmaps_shape + [18])
-        else:
-            eye.set_shape([1] + list(self._shape))
-            heatmaps.set_shape([18] + heatmaps_shape)
-        landmarks.set_shape([18, 2])
-        radius.set_shape([])
-        return eye, heatmaps, landmarks, radius
-
-    def make_initializer(self, iter):
-        self._init_op = iter.make_initializer(self._dataset)
-        self._init_op_single = iter.make_initializer(self._dataset_single)
+        return tuple(data[key] for key in self._keys)
     
-    def run(self, sess):
-        sess.run(self._init_op)
+    def _parse_record(self, serialized):
+        data = records.parse_entry(serialized, self._keys)
+        shapes = self._shapes()
+        return tuple(tf.reshape(data[key], shapes[key]) for key in self._keys)
 
-    def run_single(self, sess):
-        sess.run(self._init_op_single)
+    def _shapes(self):
+        return data_shapes(self._shape, self._heatmap_scale, self.data_format)
 
-    @property
-    def ids(self):
-        return self._ids
+    def _set_shapes(self, *tensors):
+        shapes = self._shapes()
+        for key, tensor in zip(self._keys, tensors):
+            tensor.set_shape(shapes[key])
+        return tensors
 
-    @property
-    def num_examples(self):
-        return self._num_examples
\ No newline at end of file
+    def _add_heatmaps(self, eye, landmarks, radius, heatmap_sigma):
+        return add_heatmaps(eye, landmarks, radius, heatmap_sigma, self._shape,
+                            self._heatmap_scale, self.data_format, self._heatmap_sigma)
+
+
+class MmapData(BaseData):
+    """Data backend reading batches as contiguous slices of memory-mapped arrays.
+
+    Nothing is cached in process memory, the OS page cache holds the dataset and is
+    shared between training processes. Samples are shuffled once when the arrays are
+    written (see `convert_pickles.py`), training then shuffles the order of the
+    contiguous batches every epoch, so each batch is a single sequential read. The
+    batches are still copied into tensors by `tf.data.Dataset.from_generator`.
+    """
+    def __init__(self,
+                 path,
+                 batch_size=32,
+                 shape=(150, 90),
+                 heatmap_scale=0.5,
+                 seed=7,
+                 data_format='NHWC',
+                 render_heatmaps=False,
+                 heatmap_sigma=None,
+                 augmenter=None,
+                 num_parallel_calls=None,
+                 num_parallel_reads=None,
+                 prefetch_batches=None,
+                 shard_index=0,
+                 num_shards=1):
+        self.batch_size = batch_size
+        self.data_format = data_format.upper()
+
+        # Batches are sliced by a single generator, so there are no parallel reads
+        self._num_parallel_calls = num_parallel_calls or autotune(multiprocessing.cpu_count())
+        self._prefetch_batches = prefetch_batches or autotune(2)
+
+        self._heatmap_scale = heatmap_scale
+        self._shape = shape
+        self._render_heatmaps = render_heatmaps
+        self._heatmap_sigma = heatmap_sigma
+        self._keys = LANDMARK_KEYS if render_heatmaps else HEATMAP_KEYS
+
+        # Online augmentation moves landmarks, so heatmaps have to be rendered afterwards
+        assert augmenter is None or render_heatmaps
+        self.augmenter = augmenter
+
+        self._arrays = arrays.open_arrays(path, self._keys)
+        self._num_examples = len(self._arrays['eye'])
+        self._ids = np.arange(self._num_examples)
+        # Samples are already shuffled, so each shard takes every num_shards-th batch
+        self._batch_starts = np.arange(0, self._num_examples, self.batch_size)
+        self._batch_starts = self._batch_starts[shard_index::num_shards]
+        self._seed = seed
+        self._skip_batches = 0
+        # Number of the first train batch, for the online augmentation
+        self._first_batch = tf.placeholder_with_default(tf.constant(0, tf.int64), [])
+
+        output_types = tuple(tf.float32 for _ in self._keys)
+        output_shapes = tuple(tf.TensorShape([None] + list(self._arrays[key].shape[1:]))
+                              for key in self._keys)
+
+        self._dataset_single = tf.data.Dataset.from_generator(
+            self._eval_batches, output_types, output_shapes)
+        self._dataset = tf.data.Dataset.from_generator(
+            self._train_batches, output_types, output_shapes)
+        if self.augmenter is not None:
+            self._dataset = augment_dataset(self._dataset, self.augmenter, self._first_batch)
+        if self._render_heatmaps:
+            self._dataset_single = self._dataset_single.map(
+                self._add_heatmaps, num_parallel_calls=self._num_parallel_calls)
+            self._dataset = self._dataset.map(
+                self._add_heatmaps, num_parallel_calls=self._num_parallel_calls)
+        self._dataset = self._dataset.prefetch(self._prefetch_batches)
+
+    def _batch(self, start):
+        return tuple(self._arrays[key][start:start + self.batch_size] for key in self._keys)
+
+    def _add_heatmaps(self, eye, landmarks, radius, heatmap_sigma):
+        return add_heatmaps(eye, landmarks, radius, heatmap_sigma, self._shape,
+                            self._heatmap_scale, self.data_format, self._heatmap_sigma)
+
+    def _skip_feed(self, skip_batches):
+        # Read by the generator when the iterator is initialized
+        self._skip_batches = skip_batches
+        return {self._first_batch: skip_batches}
+
+    def _train_batches(self):
+        # Restart the seeded batch order and skip batches without slicing them
+        random = np.random.RandomState(self._seed)
+        batch_starts = np.copy(self._batch_starts)
+        skip_batches = self._skip_batches
+        while True:
+            random.shuffle(batch_starts)
+            for start in batch_starts:
+                if skip_batches > 0:
+                    skip_batches -= 1
+                    continue
+                yield self._batch(start)
+
+    def _eval_batches(self):
+        for start in self._batch_starts:
+            yield self._batch(start)
@@ -5,7 +5,8 @@ import tensorflow as tf
 class ImgDataSource(object):
     def __init__(self,
                  shape=(150, 90),
-                 data_format='NHWC'):
+                 data_format='NHWC',
+                 use_iterator=False):
         
         self.image = None
         self.data_format = data_format.upper()
@@ -14,13 +15,21 @@ class ImgDataSource(object):
         self.shape = (1, shape[0], shape[1], 1) if self.data_format == 'NHWC' else (1, 1, shape[0], shape[1])
         self.x_shape = shape
         
-        self.placeholder_X = tf.placeholder(tf.float32, self.shape)
-        self.dataset = tf.data.Dataset.from_tensors((self.placeholder_X))
-        self.iter = self.dataset.make_initializable_iterator()
-        
-        self.tensors = self.iter.get_next()
+        # Batches of eye crops are fed straight to the model input (see `feed_dict` and
+        # `CNN.predict`), `use_iterator` keeps the per-frame iterator of `run_single`
+        self.placeholder_X = tf.placeholder(tf.float32, (None,) + self.shape[1:])
+        if use_iterator:
+            self.dataset = tf.data.Dataset.from_tensors((self.placeholder_X))
+            self.iter = self.dataset.make_initializable_iterator()
+            self.tensors = self.iter.get_next()
+        else:
+            self.tensors = self.placeholder_X
 
         self.eval = self
 
+    def feed_dict(self, images):
+        """Feed one eye crop or a batch of them."""
+        return {self.placeholder_X: np.reshape(images, (-1,) + self.shape[1:])}
+
     def run_single(self, sess):
         sess.run(self.iter.initializer, feed_dict={self.placeholder_X: self.image.reshape(*self.shape)})
\ No newline at end of file
@@ -3,9 +3,10 @@ from __future__ import division, print_function, absolute_import
 import argparse
 import os
 import util.util as util
+import util.records as records
 
 from data_sources.data_source import DataSource
-from models.cnn import CNN
+from models.cnn import CNN, load_model_config
 from learning.trainer import Trainer
 import glob
 
@@ -16,13 +17,18 @@ parser.add_argument('--model-checkpoint', type=str, required=True)
 parser.add_argument('--eye-shape', type=int, nargs="+", default=[90, 60])
 parser.add_argument('--heatmap-scale', type=float, default=1)
 parser.add_argument('--data-format', type=str, default='NCHW')
+parser.add_argument('--precision', type=str, default='float32',
+                    help='Compute precision of the hourglass: float32, float16 or bfloat16.')
+parser.add_argument('--render-heatmaps', action='store_true',
+                    help='Render heatmaps from landmarks (data preprocessed with --no-heatmaps).')
 
 
 def main(args):
     # Get dataset
-    test_files = glob.glob(os.path.join(args.test_path, '*.pickle'))
+    test_files = records.list_files(args.test_path)
     datasource = DataSource(None, test_files, shape=tuple(args.eye_shape),
-                            data_format=args.data_format, heatmap_scale=args.heatmap_scale)
+                            data_format=args.data_format, heatmap_scale=args.heatmap_scale,
+                            render_heatmaps=args.render_heatmaps)
 
     # Get model
     learning_schedule=[
@@ -34,7 +40,9 @@ def main(args):
             'learning_rate': 1e-3,
         }
     ]
-    model = CNN(datasource.tensors, datasource.x_shape, learning_schedule)
+    model = CNN(datasource.tensors, datasource.x_shape, learning_schedule,
+                precision=args.precision,
+                model_config=load_model_config(args.model_checkpoint))
     
     # Get evaluator
     evaluator = Trainer(model, model_checkpoint=args.model_checkpoint)
@@ -0,0 +1,104 @@
+"""Export a trained CNN checkpoint as a frozen inference graph for the live demos."""
+
+from __future__ import division, print_function, absolute_import
+
+import argparse
+import time
+import cv2 as cv
+import numpy as np
+import tensorflow as tf
+
+from data_sources.img_data_source import ImgDataSource
+from models.cnn import CNN, load_model_config
+from models.frozen_cnn import FrozenCNN, export_frozen_graph
+from preprocessing.img_preprocessor import ImgPreprocessor
+
+parser = argparse.ArgumentParser(description='Export CNN (Elg) as a frozen graph.')
+parser.add_argument('--model-checkpoint', type=str, default='checkpoints/best_cnn.ckpt')
+parser.add_argument('--output-path', type=str, default='checkpoints/best_cnn.pb')
+parser.add_argument('--eye-shape', type=int, nargs="+", default=[60, 90])
+parser.add_argument('--data-format', type=str, default='NHWC')
+parser.add_argument('--no-heatmaps', action='store_true',
+                    help='Only export the landmarks and radius outputs.')
+parser.add_argument('--moving-statistics', action='store_true',
+                    help='Normalize with the moving statistics, so batch norm is folded.')
+parser.add_argument('--benchmark-frames', type=int, default=100,
+                    help='Frames used to compare latency with the checkpoint (0 to skip).')
+parser.add_argument('--eye-image', type=str, default=None,
+                    help='Grayscale eye crop used to compare landmarks (default: noise).')
+
+
+def benchmark_checkpoint(args, eye, use_batch_statistics):
+    """Startup time and per-frame latency of rebuilding the CNN as `live_demo.py` does."""
+    t = time.time()
+    with tf.Graph().as_default():
+        datasource = ImgDataSource(shape=tuple(args.eye_shape), data_format=args.data_format)
+        model = CNN(datasource.tensors, datasource.x_shape, None, data_format=args.data_format,
+                    predict_only=True, model_config=load_model_config(args.model_checkpoint),
+                    use_batch_statistics=use_batch_statistics)
+        with tf.Session() as sess:
+            sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+            tf.train.Saver().restore(sess, args.model_checkpoint)
+
+            def run_frame():
+                return model.predict(sess, datasource.feed_dict(eye))[0]
+
+            landmarks = run_frame()
+            startup = time.time() - t
+
+            t = time.time()
+            for _ in range(args.benchmark_frames):
+                run_frame()
+            latency = (time.time() - t) / args.benchmark_frames
+    return startup, latency, landmarks
+
+
+def benchmark_frozen(args, eye):
+    t = time.time()
+    model = FrozenCNN(args.output_path)
+    landmarks = model.predict(eye)[0]
+    startup = time.time() - t
+
+    t = time.time()
+    for _ in range(args.benchmark_frames):
+        model.predict(eye)
+    latency = (time.time() - t) / args.benchmark_frames
+    model.close()
+    return startup, latency, landmarks
+
+
+def main(args):
+    export_frozen_graph(args.model_checkpoint, args.output_path, tuple(args.eye_shape),
+                        data_format=args.data_format, heatmaps=not args.no_heatmaps,
+                        use_batch_statistics=not args.moving_statistics)
+    if args.benchmark_frames <= 0:
+        return
+
+    if args.eye_image:
+        eye = cv.imread(args.eye_image, cv.IMREAD_GRAYSCALE)
+        eye = cv.resize(eye, (args.eye_shape[1], args.eye_shape[0]))
+        eye = ImgPreprocessor(args.data_format).preprocess_entry(eye)
+    else:
+        eye = np.random.uniform(-1.0, 1.0, args.eye_shape).astype(np.float32)
+    checkpoint_startup, checkpoint_latency, checkpoint_landmarks = benchmark_checkpoint(
+        args, eye, use_batch_statistics=not args.moving_statistics)
+    frozen_startup, frozen_latency, frozen_landmarks = benchmark_frozen(args, eye)
+
+    print('startup: checkpoint %.2fs, frozen %.2fs (%.2fs saved)' % (
+        checkpoint_startup, frozen_startup, checkpoint_startup - frozen_startup))
+    print('per frame: checkpoint %.2fms, frozen %.2fms (%.2fms saved)' % (
+        1e3 * checkpoint_latency, 1e3 * frozen_latency,
+        1e3 * (checkpoint_latency - frozen_latency)))
+    print('max landmark difference: %g' % np.max(np.abs(checkpoint_landmarks - frozen_landmarks)))
+
+    if args.moving_statistics:
+        # Folding changes the normalization, compare with the default per-crop statistics
+        _, default_latency, default_landmarks = benchmark_checkpoint(
+            args, eye, use_batch_statistics=True)
+        print('per frame: default checkpoint %.2fms' % (1e3 * default_latency))
+        print('max landmark difference of the moving statistics to the default: %g' %
+              np.max(np.abs(default_landmarks - frozen_landmarks)))
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,212 @@
+"""Synchronous data-parallel training of the CNN in local worker processes.
+
+Every worker builds its own graph, trains on a shard of the training data and computes
+the gradients of its batch. The gradients are averaged through shared memory (a local
+all-reduce) and every worker applies the same average, so the replicas stay identical.
+"""
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+
+from learning.trainer import Trainer
+from models.cnn import save_model_config
+
+
+class DataParallelTrainer(object):
+    """Train with `num_workers` processes, each with a batch of `batch_size` per step.
+
+    `build_fn(shard_index, num_shards)` is called in every worker and must return a
+    `(model, datasource)` tuple, with the model built with `data_parallel=True` and the
+    training data sharded. It has to be picklable, since workers are spawned.
+
+    The first worker logs, writes summaries, evaluates and saves periodic checkpoints
+    like `Trainer`; with `resume` all workers restore the latest one. `trainer_kwargs`
+    are passed to the `Trainer` of every worker.
+    """
+    def __init__(self, build_fn, num_workers, num_threads=None, poll_secs=10,
+                 **trainer_kwargs):
+        self.build_fn = build_fn
+        self.num_workers = num_workers
+        self.trainer_kwargs = trainer_kwargs
+        # Split the cores between the workers instead of letting each session use all
+        self.num_threads = num_threads or max(1, multiprocessing.cpu_count() // num_workers)
+        # How often to check whether a worker died without reporting
+        self.poll_secs = poll_secs
+
+    def run_training(self, max_steps, output_path='checkpoints/last_cnn.ckpt'):
+        """Train for `max_steps` synchronous steps, returns the total training samples/s."""
+        context = multiprocessing.get_context('spawn')
+        # The workers size the shared buffers from their own graphs, the first one
+        # creates them in this directory
+        buffer_dir = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        barrier = context.Barrier(self.num_workers)
+        results = context.Queue()
+        processes = [
+            context.Process(target=_train_worker,
+                            args=(self.build_fn, rank, self.num_workers, buffer_dir, barrier,
+                                  results, max_steps, self.num_threads, output_path,
+                                  self.trainer_kwargs))
+            for rank in range(self.num_workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            samples_per_sec = self._collect_results(processes, results, barrier)
+        finally:
+            for process in processes:
+                process.join(self.poll_secs)
+                if process.is_alive():
+                    process.terminate()
+            shutil.rmtree(buffer_dir, ignore_errors=True)
+
+        if None in samples_per_sec:
+            raise RuntimeError('data-parallel training failed in a worker')
+        total = sum(samples_per_sec)
+        print('Data-parallel training with %d workers: %.1f samples/s' % (
+            self.num_workers, total))
+        return total
+
+    def _collect_results(self, processes, results, barrier):
+        """Results of all workers, a worker killed without reporting counts as failed."""
+        samples_per_sec = []
+        while len(samples_per_sec) < len(processes):
+            try:
+                samples_per_sec.append(results.get(timeout=self.poll_secs))
+            except queue.Empty:
+                killed = [p for p in processes if p.exitcode not in (None, 0)]
+                if killed:
+                    # Release the workers waiting for the killed ones
+                    barrier.abort()
+                    print('data-parallel worker exited with code %d' % killed[0].exitcode)
+                    return samples_per_sec + [None]
+        return samples_per_sec
+
+
+def _buffer_layout(model):
+    """Size of the flat gradients and of a shared buffer row (gradients and losses).
+
+    A row also has to hold the trainable variables, which are broadcast through it.
+    """
+    gradient_size = sum(int(np.prod(p.shape.as_list())) for p in model.gradient_placeholders)
+    variable_size = sum(int(np.prod(v.shape.as_list())) for v in tf.trainable_variables())
+    return gradient_size, max(gradient_size + len(model.losses), variable_size)
+
+
+def _open_buffers(buffer_dir, rank, num_workers, buffer_size, barrier):
+    """Double buffered shared memory, so workers write step t + 1 while others read step t."""
+    paths = [os.path.join(buffer_dir, 'buffer%d' % i) for i in range(2)]
+    if rank == 0:
+        for path in paths:
+            np.memmap(path, dtype=np.float32, mode='w+', shape=(num_workers, buffer_size))
+    barrier.wait()
+    return [np.memmap(path, dtype=np.float32, mode='r+', shape=(num_workers, buffer_size))
+            for path in paths]
+
+
+def _broadcast_variables(sess, buffer, rank, barrier):
+    """Copy the initial trainable variables of the first worker to all the others."""
+    variables = tf.trainable_variables()
+    offsets = np.cumsum([0] + [int(np.prod(v.shape.as_list())) for v in variables])
+    row = buffer[0]
+    if rank == 0:
+        for i, value in enumerate(sess.run(variables)):
+            row[offsets[i]:offsets[i + 1]] = value.ravel()
+    barrier.wait()
+    if rank != 0:
+        for i, variable in enumerate(variables):
+            variable.load(row[offsets[i]:offsets[i + 1]].reshape(variable.shape.as_list()), sess)
+    # The first step reuses this buffer
+    barrier.wait()
+
+
+def _train_worker(build_fn, rank, num_workers, buffer_dir, barrier, results, *args):
+    try:
+        results.put(_run_worker(build_fn, rank, num_workers, buffer_dir, barrier, *args))
+    except Exception:
+        # Release the workers waiting for this one
+        barrier.abort()
+        results.put(None)
+        raise
+
+
+def _run_worker(build_fn, rank, num_workers, buffer_dir, barrier, max_steps, num_threads,
+                output_path, trainer_kwargs):
+    model, datasource = build_fn(rank, num_workers)
+    gradient_size, buffer_size = _buffer_layout(model)
+    buffers = _open_buffers(buffer_dir, rank, num_workers, buffer_size, barrier)
+    shapes = [p.shape.as_list() for p in model.gradient_placeholders]
+    offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in shapes])
+    loss_keys = sorted(model.losses)
+
+    # The first worker logs, evaluates and saves the model
+    chief = rank == 0
+    trainer = Trainer(model, **trainer_kwargs)
+    trainer.max_steps = max_steps
+    trainer.saver = tf.train.Saver()
+    trainer.checkpoint_saver = tf.train.Saver(max_to_keep=trainer.checkpoints_to_keep)
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=num_threads,
+                            inter_op_parallelism_threads=num_threads)
+    with tf.Session(config=config) as sess:
+        trainer.initialize_vars(sess)
+        if trainer.resume:
+            trainer.restore_checkpoint(sess)
+        _broadcast_variables(sess, buffers[0], rank, barrier)
+        trainer.run_train_data(sess, datasource)
+        trainer.loss_accumulator.reset()
+        trainer._last_checkpoint_time = time.time()
+
+        start_step = trainer.running_steps
+        start_time = time.time()
+        for step in range(start_step, max_steps):
+            # Exclude graph optimization and filling the input pipeline from the timing
+            if step == start_step + 1:
+                start_time = time.time()
+            model.train(sess)
+            write_summary = chief and step % trainer.summary_steps == 0
+            fetched = sess.run(model.compute_gradients_with_summaries if write_summary
+                               else model.compute_gradients)
+            if write_summary:
+                model.train_writer.add_summary(fetched['summary'], step)
+
+            # All-reduce: write this worker's row, wait for all rows, average them
+            buffer = buffers[step % 2]
+            row = buffer[rank]
+            for i, gradient in enumerate(fetched['gradients']):
+                row[offsets[i]:offsets[i + 1]] = gradient.ravel()
+            row[gradient_size:gradient_size + len(loss_keys)] = [
+                fetched['losses'][key] for key in loss_keys]
+            barrier.wait()
+            average = buffer.mean(axis=0)
+
+            feed_dict = {placeholder: average[offsets[i]:offsets[i + 1]].reshape(shapes[i])
+                         for i, placeholder in enumerate(model.gradient_placeholders)}
+            sess.run(model.apply_gradients, feed_dict=feed_dict)
+            trainer.step, trainer.running_steps = step, step + 1
+
+            if chief:
+                trainer.loss_accumulator.add(dict(zip(
+                    loss_keys, average[gradient_size:gradient_size + len(loss_keys)])))
+                if trainer.running_steps % trainer.log_steps == 0:
+                    trainer.flush_losses()
+                # The other workers wait at the next all-reduce meanwhile
+                if trainer.running_steps % trainer.eval_steps_mod == 0:
+                    trainer.eval(sess, datasource)
+                    datasource.train.run(sess)
+                if (trainer.running_steps % trainer.checkpoint_steps == 0 or
+                        time.time() - trainer._last_checkpoint_time > trainer.checkpoint_secs):
+                    trainer.save_checkpoint(sess)
+
+        timed_steps = max(1, max_steps - start_step - 1)
+        samples_per_sec = timed_steps * datasource.batch_size / (time.time() - start_time)
+        if chief:
+            trainer.saver.save(sess, output_path)
+            save_model_config(output_path, model.config)
+            print('Model saved at %s' % output_path)
+    datasource.close()
+    return samples_per_sec
@@ -0,0 +1,104 @@
+import csv
+import multiprocessing
+import os
+import queue
+import tensorflow as tf
+
+from learning.trainer import Trainer
+
+
+class BackgroundEvaluator(object):
+    """Evaluate training checkpoints in a separate process.
+
+    `submit` writes a checkpoint and returns right away, the worker process restores it,
+    runs the whole eval set, appends the average losses to `results_path` (plus the eval
+    summaries) and saves `best_checkpoint` when `heatmaps_mse` improves. With `resume`
+    it has to improve on the best loss already in `results_path`.
+
+    `build_fn` is called in the worker and must return a `(model, datasource)` tuple
+    for evaluation. It has to be picklable (e.g. a module level function or a
+    `functools.partial` of one), since the worker is spawned rather than forked.
+    """
+    def __init__(self, build_fn,
+                 checkpoint_path='checkpoints/eval_cnn.ckpt',
+                 best_checkpoint='checkpoints/best_cnn.ckpt',
+                 results_path='checkpoints/eval_results.csv',
+                 num_threads=0,
+                 resume=True):
+        self.checkpoint_path = checkpoint_path
+        self._saver = tf.train.Saver(max_to_keep=3)
+
+        # Forking a process that already runs a TF session is not safe, so spawn it
+        context = multiprocessing.get_context('spawn')
+        # At most one checkpoint waits while another one is evaluated
+        self._queue = context.Queue(maxsize=1)
+        self._process = context.Process(
+            target=_evaluate_checkpoints,
+            args=(build_fn, self._queue, best_checkpoint, results_path, num_threads,
+                  resume))
+        self._process.daemon = True
+        self._process.start()
+
+    def submit(self, sess, step):
+        """Save a checkpoint for evaluation, returns False if the worker is still busy."""
+        if not self._process.is_alive():
+            raise RuntimeError('background evaluator exited with code %s' %
+                               self._process.exitcode)
+        if self._queue.full():
+            return False
+        checkpoint = self._saver.save(sess, self.checkpoint_path, global_step=step)
+        self._queue.put((checkpoint, step))
+        return True
+
+    def close(self, poll_secs=10):
+        """Wait for the queued evaluations to finish and stop the worker."""
+        # The queue stays full if the worker died, so check it while waiting
+        while self._process.is_alive():
+            try:
+                self._queue.put(None, timeout=poll_secs)
+                break
+            except queue.Full:
+                pass
+        self._process.join()
+        if self._process.exitcode != 0:
+            print('background evaluator exited with code %s' % self._process.exitcode)
+
+
+def best_eval_loss(results_path, loss='heatmaps_mse'):
+    """Lowest `loss` in the results written by previous evaluations, None if there are none."""
+    if not os.path.exists(results_path):
+        return None
+    with open(results_path, 'r') as f:
+        values = [float(row[loss]) for row in csv.DictReader(f) if row.get(loss)]
+    return min(values) if values else None
+
+
+def _evaluate_checkpoints(build_fn, checkpoint_queue, best_checkpoint, results_path,
+                          num_threads, resume):
+    model, datasource = build_fn()
+    trainer = Trainer(model, best_checkpoint=best_checkpoint)
+    trainer.saver = tf.train.Saver()
+    # A resumed run only replaces the best checkpoint when it improves on it
+    best_loss = best_eval_loss(results_path) if resume else None
+    if best_loss is not None and tf.train.checkpoint_exists(best_checkpoint):
+        trainer.best_loss = best_loss
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=num_threads,
+                            inter_op_parallelism_threads=num_threads)
+    with tf.Session(config=config) as sess:
+        trainer.initialize_vars(sess)
+        while True:
+            item = checkpoint_queue.get()
+            if item is None:
+                break
+            checkpoint, step = item
+            trainer.saver.restore(sess, checkpoint)
+            trainer.running_steps = step
+            losses = trainer.eval(sess, datasource)
+
+            write_header = not os.path.exists(results_path)
+            with open(results_path, 'a') as f:
+                writer = csv.writer(f)
+                if write_header:
+                    writer.writerow(['step'] + sorted(losses))
+                writer.writerow([step] + [losses[key] for key in sorted(losses)])
@@ -1,13 +1,66 @@
 import tensorflow as tf
 import numpy as np
+import time
 import csv
+import os
+import ujson
 
 from util import util
+from models.cnn import save_model_config
+
+
+class LossAccumulator(object):
+    """Running average of the training losses since the last flush."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.count = 0
+        self.start_time = time.time()
+
+    def add(self, losses):
+        for key in losses:
+            self.sums[key] = self.sums.get(key, 0.0) + losses[key]
+        self.count += 1
+
+    def flush(self):
+        """Return the average losses and steps/s since the last flush, then reset."""
+        averages = {key: self.sums[key] / self.count for key in self.sums}
+        steps_per_sec = self.count / max(time.time() - self.start_time, 1e-6)
+        self.reset()
+        return averages, steps_per_sec
+
 
 class Trainer(object):
-    def __init__(self, model, model_checkpoint='checkpoints/last_cnn.ckpt', eval_steps=10000):
+    def __init__(self, model, model_checkpoint='checkpoints/last_cnn.ckpt', eval_steps=10000,
+                 best_checkpoint='checkpoints/best_cnn.ckpt', background_evaluator=None,
+                 summary_steps=100, log_steps=100,
+                 checkpoint_path='checkpoints/resume/cnn.ckpt', checkpoint_steps=1000,
+                 checkpoint_secs=600, checkpoints_to_keep=3, resume=True):
         self.model = model
 
+        # Periodic checkpoints, written every `checkpoint_steps` steps or `checkpoint_secs`
+        # seconds (whichever comes first), the latest one is restored when `resume`
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_steps = checkpoint_steps
+        self.checkpoint_secs = checkpoint_secs
+        self.checkpoints_to_keep = checkpoints_to_keep
+        self.resume = resume
+        self.best_checkpoint = best_checkpoint
+        self.data = None
+        # Seed of the online augmentation of the restored checkpoint
+        self.augmenter_seed = None
+
+        # Merged summaries are written every `summary_steps`, the averaged losses and
+        # steps/s are logged every `log_steps`
+        self.summary_steps = summary_steps
+        self.log_steps = log_steps
+        self.loss_accumulator = LossAccumulator()
+
+        # Evaluates checkpoints in another process instead of pausing training
+        self.background_evaluator = background_evaluator
+
         self.eval_steps_mod = eval_steps
         self.exec_name = 'train'
         self.running_losses = {}
@@ -19,20 +72,64 @@ class Trainer(object):
     def run_training(self, data, max_steps, eval=True, test=True, output_path='checkpoints/last_cnn.ckpt'):
         self.max_steps = max_steps
         self.saver = tf.train.Saver()
+        self.checkpoint_saver = tf.train.Saver(max_to_keep=self.checkpoints_to_keep)
         print('Training')
 
         with tf.Session() as sess:
             self.initialize_vars(sess)
+            if self.resume:
+                self.restore_checkpoint(sess)
             self.train(sess,data, eval=eval)
 
             self.saver.save(sess, output_path)
+            save_model_config(output_path, self.model.config)
             print('Model saved at %s' % output_path)
 
+        if self.background_evaluator is not None:
+            self.background_evaluator.close()
+        data.close()
+
+    def save_checkpoint(self, sess):
+        """Save the model, optimizer state and the running losses of the trainer."""
+        util.mkdir(os.path.dirname(self.checkpoint_path))
+        path = self.checkpoint_saver.save(sess, self.checkpoint_path,
+                                          global_step=self.running_steps)
+        state = {
+            'running_steps': self.running_steps,
+            'running_losses': {key: float(v) for key, v in self.running_losses.items()},
+            'best_loss': float(self.best_loss),
+        }
+        if self.data is not None and self.data.train.augmenter is not None:
+            state['augmenter_seed'] = self.data.train.augmenter.seed
+        with open(path + '.json', 'w') as f:
+            ujson.dump(state, f)
+
+        # The saver rotates old checkpoints, remove their trainer state as well
+        for old_state in tf.gfile.Glob(self.checkpoint_path + '-*.json'):
+            if old_state[:-len('.json')] not in self.checkpoint_saver.last_checkpoints:
+                os.remove(old_state)
+        self._last_checkpoint_time = time.time()
+
+    def restore_checkpoint(self, sess):
+        """Restore the latest periodic checkpoint, returns False if there is none."""
+        path = tf.train.latest_checkpoint(os.path.dirname(self.checkpoint_path))
+        if path is None or not os.path.exists(path + '.json'):
+            return False
+        self.checkpoint_saver.restore(sess, path)
+        with open(path + '.json', 'r') as f:
+            state = ujson.load(f)
+        self.running_steps = state['running_steps']
+        self.running_losses = state['running_losses']
+        self.best_loss = state['best_loss']
+        self.augmenter_seed = state.get('augmenter_seed')
+        print('Resumed training from %s at step %d' % (path, self.running_steps))
+        return True
+
     def run_eval(self, eval_data):
         self.saver = tf.train.Saver()
         with tf.Session() as sess:
             self.saver.restore(sess, self.model_checkpoint)
-            self.eval(sess, eval_data)
+            return self.eval(sess, eval_data)
     
     def run_predict(self, eval_data):
         saver = tf.train.Saver()
@@ -77,39 +174,78 @@ class Trainer(object):
                 self.eval_step(sess, data)
             except tf.errors.OutOfRangeError:
                 s = ''
+                avg_losses = {}
                 for loss in self.eval_losses:
                     avg_loss = self.eval_losses[loss] / self.eval_steps
+                    avg_losses[loss] = avg_loss
                     if loss == 'heatmaps_mse' and avg_loss < self.best_loss:
-                        self.saver.save(sess, 'checkpoints/best_cnn.ckpt')
+                        self.saver.save(sess, self.best_checkpoint)
+                        save_model_config(self.best_checkpoint, self.model.config)
                         self.best_loss = avg_loss
 
                     s += 'Evaluation Loss %s: %g' % (loss, avg_loss)
                     s += '  |  '
                 print(s)
-                break
+                return avg_losses
 
-    def train(self, sess, data, eval=True):
+    def run_train_data(self, sess, data):
+        """Select the train data, skipping the batches seen before `running_steps`."""
         self.data = data
-        data.train.run(sess)
-        for self.step in range(self.max_steps):
+        skip_batches = self.running_steps * self.model.accumulation_steps
+        if data.train.augmenter is not None and self.augmenter_seed is not None:
+            # Batches are numbered from skip_batches, so with the same seed they get the
+            # same augmentation as in an uninterrupted run
+            data.train.augmenter.seed = self.augmenter_seed
+        data.train.run(sess, skip_batches=skip_batches)
+
+    def train(self, sess, data, eval=True):
+        # When resuming, skip the batches the restored model has already seen
+        self.run_train_data(sess, data)
+        self.loss_accumulator.reset()
+        self._last_checkpoint_time = time.time()
+        for self.step in range(self.running_steps, self.max_steps):
             self.train_step(sess, data, eval=eval)
+            if (self.running_steps % self.checkpoint_steps == 0 or
+                    time.time() - self._last_checkpoint_time > self.checkpoint_secs):
+                self.save_checkpoint(sess)
 
     def train_step(self, sess, data, eval=True):
         self.train_batch(sess, data)
         if eval and ((self.running_steps % self.eval_steps_mod == 0) or (self.running_steps + 1 == self.max_steps) or self.running_steps == 1):
             self.eval_step_train(sess, data.train)
-            self.eval(sess, data)
-            data.train.run(sess)
+            if self.background_evaluator is not None:
+                if not self.background_evaluator.submit(sess, self.running_steps):
+                    print('Background evaluation still running, skipping step %d' % self.running_steps)
+            else:
+                self.eval(sess, data)
+                data.train.run(sess)
 
     def train_batch(self, sess, data):
         self.model.train(sess)
-        summary, _, losses = self.model.train_iteration(sess)
-        self.model.train_writer.add_summary(summary, self.running_steps)
+        write_summary = self.running_steps % self.summary_steps == 0
+        summary, _, losses = self.model.train_iteration(sess, with_summaries=write_summary)
+        if summary is not None:
+            self.model.train_writer.add_summary(summary, self.running_steps)
         for key in losses:
             if key not in self.running_losses:
                 self.running_losses[key] = 0
             self.running_losses[key] += losses[key]
+        self.loss_accumulator.add(losses)
         self.running_steps += 1
+        if self.running_steps % self.log_steps == 0:
+            self.flush_losses()
+
+    def flush_losses(self):
+        """Log the losses averaged since the last flush and the training speed."""
+        averages, steps_per_sec = self.loss_accumulator.flush()
+        summary = tf.Summary()
+        s = ''
+        for key in sorted(averages):
+            summary.value.add(tag='average/%s' % key, simple_value=averages[key])
+            s += 'Average Loss %s: %g  |  ' % (key, averages[key])
+        summary.value.add(tag='steps_per_sec', simple_value=steps_per_sec)
+        self.model.train_writer.add_summary(summary, self.running_steps)
+        self.print_progress(s + '%.1f steps/s' % steps_per_sec)
 
 
     def eval_step_train(self, sess, data):
@@ -23,7 +23,10 @@ import math
 
 from data_sources.img_data_source import ImgDataSource
 from preprocessing.img_preprocessor import ImgPreprocessor
-from models.cnn import CNN
+from models.cnn import CNN, load_model_config
+from models.frozen_cnn import FrozenCNN
+from util.face_tracker import FaceTracker, shape_to_coords
+from util.gaze import landmark_confidence
 from learning.trainer import Trainer
 
 
@@ -36,6 +39,19 @@ parser.add_argument('--model-crop-eyes', type=str, default='shape_predictor_68_f
 parser.add_argument('--eye-shape', type=int, nargs="+", default=[60, 90])
 parser.add_argument('--heatmap-scale', type=float, default=1)
 parser.add_argument('--data-format', type=str, default='NHWC')
+parser.add_argument('--frozen-graph', type=str, default=None,
+                    help='Frozen graph exported by export_cnn.py, used instead of the checkpoint.')
+parser.add_argument('--precision', type=str, default='float32',
+                    help='Compute precision of the hourglass: float32, float16 or bfloat16.')
+parser.add_argument('--exit-module', type=int, default=None,
+                    help='Stop inference after this hourglass module.')
+parser.add_argument('--adaptive-exit', action='store_true',
+                    help='Stop every eye at the first module confident enough for the gaze.')
+parser.add_argument('--detect-every', type=int, default=10,
+                    help='Run the face detector on the whole frame every N frames.')
+parser.add_argument('--detection-width', type=int, default=800,
+                    help='Width of the resized frame used for face detection.')
+parser.add_argument('--display-width', type=int, default=800)
 parser.add_argument('-src', '--source', dest='video_source', type=int,
                     default=0, help='Device index of the camera.')
 parser.add_argument('-num-w', '--num-workers', dest='num_workers', type=int,
@@ -43,6 +59,11 @@ parser.add_argument('-num-w', '--num-workers', dest='num_workers', type=int,
 parser.add_argument('-q-size', '--queue-size', dest='queue_size', type=int,
                     default=1, help='Size of the queue.')
 args = parser.parse_args()
+# The frozen graph has a fixed precision and no early exits
+if args.frozen_graph and (args.exit_module is not None or args.adaptive_exit or
+                          args.precision != 'float32'):
+    parser.error('--exit-module, --adaptive-exit and --precision are not supported '
+                 'with --frozen-graph')
 
 
 import pygame
@@ -59,21 +80,6 @@ CURSOR_X = int(MAX_Y / 2)
 CURSOR_Y = int(MAX_X / 2)
 
 
-# Function for creating landmark coordinate list
-def land2coords(landmarks, dtype="int"):
-    # initialize the list of tuples
-    # (x, y)-coordinates
-    coords = np.zeros((68, 2), dtype=dtype)
-
-    # loop over the eyes landmarks and convert them
-    # to a 2-tuple of (a, b)-coordinates
-    for i in range(36, 48):
-        coords[i] = (landmarks.part(i).x, landmarks.part(i).y)
-
-    # return the list of (a, b)-coordinates
-    return coords
-
-
 def get_eye_info(landmarks, frame_gray):
     # Segment eyes
     oh, ow = tuple(args.eye_shape)
@@ -162,13 +168,10 @@ def move_mouse(theta, phi, thresholds, intensity=80):
     os.system(cmd)
 
 
-def estimate_gaze(gaze_history, eye, heatmaps, face_landmarks, eye_landmarks,
+def estimate_gaze(gaze_history, eye, heatmaps_amax, face_landmarks, eye_landmarks,
                   eye_radius, face, frame_rgb, thresholds):
     # Gaze estimation
-    heatmaps_amax = np.amax(heatmaps.reshape(-1, 18), axis=0)
-    can_use_eye = np.all(heatmaps_amax > 0.7)
-    can_use_eyelid = np.all(heatmaps_amax[0:8] > 0.75)
-    can_use_iris = np.all(heatmaps_amax[8:16] > 0.8)
+    can_use_eye, can_use_eyelid, can_use_iris = landmark_confidence(heatmaps_amax)
     bgr = frame_rgb
     # bgr = cv2.flip(bgr, flipCode=1)
     eye_image = eye['image']
@@ -278,16 +281,13 @@ def estimate_gaze(gaze_history, eye, heatmaps, face_landmarks, eye_landmarks,
         return bgr, gaze_history, None
 
 
-def detect_eye_landmarks(image_np, datasource, preprocessor, sess, model):
-    preprocessed_image = preprocessor.preprocess_entry(image_np)
-    datasource.image = preprocessed_image
-    datasource.run_single(sess)
-    model.eval(sess)
-    input_image, eye_landmarks, eye_heatmaps, eye_radius = model.run_model(
-        sess)
-    assert np.all(input_image == preprocessed_image), (input_image,
-                                                       preprocessed_image)
-    return eye_landmarks, eye_heatmaps, eye_radius
+def detect_eye_landmarks(images, datasource, preprocessor, sess, model):
+    # Every eye of every face in a single forward pass
+    preprocessed_images = np.stack([preprocessor.preprocess_entry(image) for image in images])
+    if args.frozen_graph:
+        return model.predict_eyes(preprocessed_images)
+    return model.predict_eyes(sess, datasource.feed_dict(preprocessed_images),
+                              exit_module=args.exit_module, adaptive_exit=args.adaptive_exit)
 
 
 def setup():
@@ -296,11 +296,16 @@ def setup():
     data_format = args.data_format
     shape = tuple(args.eye_shape)
     preprocessor = ImgPreprocessor(data_format)
+    if args.frozen_graph:
+        # Nothing to rebuild or restore
+        model = FrozenCNN(args.frozen_graph)
+        return None, preprocessor, model.sess, model
     datasource = ImgDataSource(shape=shape,
                                data_format=data_format)
     # Get model
     model = CNN(datasource.tensors, datasource.x_shape, None,
-                data_format=data_format, predict_only=True)
+                data_format=data_format, predict_only=True, precision=args.precision,
+                model_config=load_model_config(args.model_checkpoint))
 
     # Start session
     saver = tf.train.Saver()
@@ -381,41 +386,41 @@ if __name__ == '__main__':
     # get file:shape_predictor_68_face_landmarks.dat from
     # link: https://drive.google.com/firun_prele/d/1XvAobn_6xeb8Ioa8PBnpCXZm8mgkBTiJ/view?usp=sharing
     landmark_predictor = dlib.shape_predictor(args.model_crop_eyes)
+    # Between detections faces are searched around their previous landmarks
+    face_tracker = FaceTracker(face_detector, landmark_predictor,
+                               detect_every=args.detect_every,
+                               detection_width=args.detection_width)
 
     thresholds = util.load_pickle('thresholds.pickle')
 
     count = 0
 
-    gaze_history = []
+    gaze_histories = {}
     while True:  # fps._numFrames < 120
         frame = video_capture.read()
         t = time.time()
 
-        # resizing frame
         window_name = "Ajna"
         # cv2.namedWindow(window_name, cv2.WND_PROP_FULLSCREEN)
         # cv2.setWindowProperty(
         #     window_name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
 
-        frame = imutils.resize(frame, width=800)
-
+        # Faces are detected on a downscaled frame, landmarks and eye crops use the
+        # camera resolution
         frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         # grayscale conversion of image because it is computationally efficient
         # to perform operations on single channeled (grayscale) image
         frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
-        # detecting faces
-        face_boundaries = face_detector(frame_gray, 0)
+        # detecting faces and predicting their landmarks
+        faces = face_tracker.update(frame_gray)
         # if there's no face do nothing
-        if len(face_boundaries) < 1:
+        if len(faces) < 1:
             continue
 
-        face = face_boundaries[0]
-        # for face in face_boundaries:
-        # Let's predict the landmarks
-        landmarks = landmark_predictor(frame_gray, face)
-        # converting co-ordinates to NumPy array
-        landmarks = land2coords(landmarks)
+        face_boundaries = [face for face, _ in faces]
+        faces_landmarks = [shape_to_coords(shape) for _, shape in faces]
+        landmarks = faces_landmarks[0]
 
         if count == 0:
             focal_length = get_focal_length(
@@ -435,20 +440,33 @@ if __name__ == '__main__':
 
         # cv2.circle(frame, (447, 63), 10, (0, 0, 255), -1)
 
-        eyes = get_eye_info(landmarks, frame_gray)
-        face = (face.left(), face.top(), face.right(), face.bottom())
-        for eye in eyes:
-            input_q.put(eye['image'])
-            eye_landmarks, heatmaps, eye_radius = output_q.get()
-            eye_landmarks = eye_landmarks.reshape(18, 2)
-            bgr, gaze_history, gaze = estimate_gaze(
-                gaze_history, eye, heatmaps, landmarks, eye_landmarks, eye_radius, face, frame, thresholds)
-
-            for (a, b) in landmarks.reshape(-1, 2):
+        faces_eyes = [get_eye_info(face_landmarks, frame_gray)
+                      for face_landmarks in faces_landmarks]
+        eye_images = [eye['image'] for eyes in faces_eyes for eye in eyes]
+        if not eye_images:
+            continue
+        input_q.put(eye_images)
+        outputs = output_q.get()
+
+        bgr = frame
+        i = 0
+        for f, (face, face_landmarks, eyes) in enumerate(
+                zip(face_boundaries, faces_landmarks, faces_eyes)):
+            face = (face.left(), face.top(), face.right(), face.bottom())
+            for eye in eyes:
+                eye_landmarks = outputs['landmarks'][i].reshape(18, 2)
+                key = (f, eye['side'])
+                bgr, gaze_histories[key], gaze = estimate_gaze(
+                    gaze_histories.get(key, []), eye, outputs['heatmaps_amax'][i],
+                    face_landmarks, eye_landmarks, outputs['radius'][i:i + 1], face,
+                    frame, thresholds)
+                i += 1
+
+            for (a, b) in face_landmarks.reshape(-1, 2):
                 cv2.circle(frame, (a, b), 2, (0, 255, 0), -1)
 
         print('[INFO] elapsed time: {:.2f}'.format(time.time() - t))
-        cv2.imshow(window_name, bgr)
+        cv2.imshow(window_name, imutils.resize(bgr, width=args.display_width))
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
 
@@ -3,11 +3,71 @@ Based on: https://github.com/swook/GazeML
 Modified by: @mari-linhares
 '''
 
+import os
+import ujson
 import tensorflow as tf
 import numpy as np
 
+from util.gaze import landmark_confidence
+
+# Hourglass architectures, the config of a model is saved next to its checkpoints.
+# The fast variants trade some landmark accuracy for eye-crop throughput, a first layer
+# stride of 2 halves the heatmaps, so they need to be trained with --heatmap-scale 0.5
+MODEL_CONFIGS = {
+    'default': {
+        'first_layer_stride': 1,
+        'num_modules': 3,
+        'num_feature_maps': 32,
+        'hourglass_depth': 4,
+        'num_residual_blocks': 1,
+        'separable_convs': False,
+    },
+    'fast': {
+        'first_layer_stride': 1,
+        'num_modules': 2,
+        'num_feature_maps': 32,
+        'hourglass_depth': 4,
+        'num_residual_blocks': 1,
+        'separable_convs': True,
+    },
+    'fastest': {
+        'first_layer_stride': 2,
+        'num_modules': 1,
+        'num_feature_maps': 16,
+        'hourglass_depth': 3,
+        'num_residual_blocks': 1,
+        'separable_convs': True,
+    },
+}
+CONFIG_SUFFIX = '.config.json'
+
+
+def get_model_config(config=None):
+    """Full model config from a preset name or a (partial) dict, `None` is the default."""
+    if config is None or isinstance(config, str):
+        return dict(MODEL_CONFIGS[config or 'default'])
+    full_config = dict(MODEL_CONFIGS['default'])
+    full_config.update(config)
+    return full_config
+
+
+def save_model_config(checkpoint_path, config):
+    with open(checkpoint_path + CONFIG_SUFFIX, 'w') as f:
+        ujson.dump(config, f)
+
+
+def load_model_config(checkpoint_path):
+    """Config saved with a checkpoint, the default one for checkpoints saved without it."""
+    if not os.path.exists(checkpoint_path + CONFIG_SUFFIX):
+        return get_model_config()
+    with open(checkpoint_path + CONFIG_SUFFIX, 'r') as f:
+        return get_model_config(ujson.load(f))
+
+
 class CNN(object):
-    def __init__(self, data_holder, input_shape, learning_schedule, data_format='NCHW', predict_only=False):
+    def __init__(self, data_holder, input_shape, learning_schedule, data_format='NCHW', predict_only=False,
+                 data_parallel=False, accumulation_steps=1, precision='float32', loss_scale=None,
+                 model_config=None, use_batch_statistics=True):
         self._training = tf.Variable(True, dtype=tf.bool, trainable=False)
         self._train = tf.assign(self._training, True)
         self._eval = tf.assign(self._training, False)
@@ -17,19 +77,39 @@ class CNN(object):
 
         self.define_data(data_holder, predict_only)
 
-        self._hg_first_layer_stride = 1
-        self._hg_num_modules = 3
-        self._hg_num_feature_maps = 32
+        self.config = get_model_config(model_config)
+        self._hg_first_layer_stride = self.config['first_layer_stride']
+        self._hg_num_modules = self.config['num_modules']
+        self._hg_num_feature_maps = self.config['num_feature_maps']
+        self._hg_depth = self.config['hourglass_depth']
         self._hg_num_landmarks = 18
-        self._hg_num_residual_blocks = 1
+        self._hg_num_residual_blocks = self.config['num_residual_blocks']
+        self._hg_separable_convs = self.config['separable_convs']
 
         # NCHW
         self._data_format_longer = 'channels_first' if data_format == 'NCHW' else 'channels_last'
         self._data_format = data_format
-        self.use_batch_statistics = True
-        self.is_training = True
+        # Batch norm normalizes with the batch statistics unless `use_batch_statistics`
+        # is False, the moving statistics are only updated when training
+        self.use_batch_statistics = use_batch_statistics
+        self.is_training = not predict_only
 
         self._learning_schedule = learning_schedule
+        # Gradients are fetched and fed back averaged instead of applied in the graph
+        self._data_parallel = data_parallel
+        # Gradients of this many micro-batches are summed before each optimizer step
+        self.accumulation_steps = accumulation_steps
+        assert accumulation_steps >= 1
+        assert not (data_parallel and accumulation_steps > 1)
+
+        # Convolutions and batch norm of the hourglass run in `precision`, weights, the
+        # soft-argmax and the radius regression stay in float32. Losses are scaled by
+        # `loss_scale` before computing gradients so float16 gradients do not underflow.
+        assert precision in ('float32', 'float16', 'bfloat16')
+        self._compute_dtype = tf.as_dtype(precision)
+        if loss_scale is None:
+            loss_scale = 128.0 if precision == 'float16' else 1.0
+        self._loss_scale = loss_scale
 
         self.get_model(predict_only)
 
@@ -40,12 +120,113 @@ class CNN(object):
         return tf.reduce_mean(tf.squared_difference(x, y))
 
 
-    def train_iteration(self, sess, *args, **kwargs):
-        sess.run(self.increase_train_count)
-        return sess.run(self.backprop)
+    def train_iteration(self, sess, with_summaries=True):
+        """Run one optimization step, the summaries are only fetched if `with_summaries`."""
+        if self.accumulation_steps > 1:
+            return self._accumulated_train_iteration(sess, with_summaries)
+        if with_summaries:
+            results = sess.run(self.backprop_with_summaries)
+        else:
+            results = sess.run(self.backprop)
+        return results.get('summary'), results['optimize'], results['losses']
+
+    def _accumulated_train_iteration(self, sess, with_summaries):
+        """Accumulate the gradients of `accumulation_steps` micro-batches, then apply them."""
+        losses = {}
+        for i in range(self.accumulation_steps):
+            last = i + 1 == self.accumulation_steps
+            results = sess.run(self.backprop_with_summaries if with_summaries and last
+                               else self.backprop)
+            for key, value in results['losses'].items():
+                losses[key] = losses.get(key, 0.0) + value / self.accumulation_steps
+        optimize = sess.run(self.apply_accumulated)
+        return results.get('summary'), optimize, losses
     
-    def run_model(self, sess):
-        return sess.run([self.X, self.landmarks, self.heatmaps, self.radius])
+    def run_model(self, sess, exit_module=None, adaptive_exit=False):
+        """Run inference on the data source, returns input, landmarks, heatmaps and radius.
+
+        `exit_module` (counted from 1) always stops after that module. With
+        `adaptive_exit` the modules run one at a time and every crop stops once its
+        heatmap peaks pass the confidence thresholds of the gaze estimation (see
+        `util.gaze.landmark_confidence`), up to `exit_module` or the last module, so the
+        next module only runs on the crops left. The module used is kept in
+        `last_exit_module`, one per crop with `adaptive_exit`. Early exits are only built
+        for `predict_only` models.
+        """
+        return self._run_outputs(sess, [self.X], exit_module, adaptive_exit)
+
+    def predict(self, sess, feed_dict, exit_module=None, adaptive_exit=False):
+        """Landmarks, heatmaps and radius of a batch fed through `feed_dict`.
+
+        All outputs are fetched in a single `sess.run` (unless exiting adaptively), there
+        is no iterator to initialize and no training flag to assign, batch norm is fixed
+        to inference when the graph is built with `predict_only`.
+        """
+        return self._run_outputs(sess, [], exit_module, adaptive_exit, feed_dict)
+
+    def predict_eyes(self, sess, feed_dict, heatmaps=False, exit_module=None,
+                     adaptive_exit=False):
+        """Per-crop outputs of a stack of eye crops, computed in one forward pass.
+
+        Returns a dict of arrays with one row per crop: `landmarks`, `radius` and
+        `heatmaps_amax` (peak of every landmark heatmap, used as confidence), plus
+        `heatmaps` when requested. The peaks are computed in the graph, so by default
+        the heatmaps are not copied out of the session. Only for `predict_only` models,
+        whose batch norm normalizes every crop on its own, so results do not depend on
+        the batch. Exits work as in `run_model`, every crop stops at its own module.
+        """
+        names = ['landmarks', 'radius', 'heatmaps_amax'] + (['heatmaps'] if heatmaps else [])
+        _, outputs = self._run_exits(sess, names, [], exit_module, adaptive_exit, feed_dict)
+        return outputs
+
+    def _run_outputs(self, sess, extra_fetches, exit_module=None, adaptive_exit=False,
+                     feed_dict=None):
+        names = ['landmarks', 'heatmaps', 'radius']
+        extra_results, outputs = self._run_exits(sess, names, extra_fetches, exit_module,
+                                                 adaptive_exit, feed_dict)
+        return extra_results + [outputs[name] for name in names]
+
+    def _run_exits(self, sess, names, extra_fetches, exit_module=None, adaptive_exit=False,
+                   feed_dict=None):
+        """Fetch `extra_fetches` and the `names` outputs of the exit to use, as a dict."""
+        if exit_module is None and not adaptive_exit:
+            outputs = {'landmarks': self.landmarks, 'heatmaps': self.heatmaps,
+                       'radius': self.radius}
+            if not self.is_training:
+                outputs['heatmaps_amax'] = self.heatmaps_amax
+            return sess.run((extra_fetches, {name: outputs[name] for name in names}),
+                            feed_dict=feed_dict)
+
+        last_module = exit_module or self._hg_num_modules
+        if not adaptive_exit:
+            self.last_exit_module = last_module
+            outputs = self.exits[last_module - 1]
+            return sess.run((extra_fetches, {name: outputs[name] for name in names}),
+                            feed_dict=feed_dict)
+
+        # Later modules are computed from the fed output of the previous one, only for
+        # the crops that are not confident enough yet
+        for i in range(last_module):
+            fetches = {name: self.exits[i][name]
+                       for name in set(names) | {'heatmaps_amax', 'state'}}
+            fetches['extra'] = extra_fetches if i == 0 else []
+            results = sess.run(fetches, feed_dict=feed_dict)
+            if i == 0:
+                extra_results = results['extra']
+                outputs = {name: results[name] for name in names}
+                remaining = np.arange(len(results['heatmaps_amax']))
+                exit_modules = np.ones(len(remaining), dtype=np.int32)
+            else:
+                for name in names:
+                    outputs[name][remaining] = results[name]
+                exit_modules[remaining] = i + 1
+            passed = np.logical_and.reduce(landmark_confidence(results['heatmaps_amax']))
+            remaining = remaining[~passed]
+            if len(remaining) == 0 or i + 1 == last_module:
+                break
+            feed_dict = {self.exits[i]['state']: results['state'][~passed]}
+        self.last_exit_module = exit_modules
+        return extra_results, outputs
 
     def eval_iteration(self, sess):
         return sess.run(self.run_eval)
@@ -83,45 +264,132 @@ class CNN(object):
             self.Y3 = data_holder[3]
     
     def build_optimizer(self):
+        if self._data_parallel:
+            self._build_gradient_ops()
+            return
         self._build_optimizers()
-        self.backprop = [self.summaries] + self._optimize_ops + [self.losses]
+        # Serializing summaries every step is costly, so they are a separate fetch
+        if self.accumulation_steps > 1:
+            self.backprop = {
+                'optimize': self._accumulate_ops,
+                'losses': self.losses,
+            }
+            self.apply_accumulated = self._optimize_ops + [self.increase_train_count]
+        else:
+            self.backprop = {
+                'optimize': self._optimize_ops,
+                'losses': self.losses,
+                'train_count': self.increase_train_count,
+            }
+        self.backprop_with_summaries = dict(self.backprop, summary=self.summaries)
     
+    @staticmethod
+    def _variables_to_train(prefixes):
+        variables_to_train = []
+        for prefix in prefixes:
+            variables_to_train += [
+                v for v in tf.trainable_variables()
+                if v.name.startswith(prefix)
+            ]
+        return variables_to_train
+
+    def _compute_gradients(self, optimizer, loss, var_list):
+        """Gradients of `loss` computed with loss scaling, `None` gradients are dropped."""
+        grads_and_vars = optimizer.compute_gradients(loss * self._loss_scale, var_list=var_list)
+        return [(g / self._loss_scale if self._loss_scale != 1.0 else g, v)
+                for g, v in grads_and_vars if g is not None]
+
     def _build_optimizers(self):
         """Based on learning schedule, create optimizer instances."""
         self._optimize_ops = []
-        all_trainable_variables = tf.trainable_variables()
+        self._accumulate_ops = []
         for spec in self._learning_schedule:
             optimize_ops = []
             loss_terms = spec['loss_terms_to_optimize']
             assert isinstance(loss_terms, dict)
             for loss_term_key, prefixes in loss_terms.items():
-                variables_to_train = []
-                for prefix in prefixes:
-                    variables_to_train += [
-                        v for v in all_trainable_variables
-                        if v.name.startswith(prefix)
-                    ]
-                optimize_op = tf.train.AdamOptimizer(
+                variables_to_train = self._variables_to_train(prefixes)
+                optimizer = tf.train.AdamOptimizer(
                     learning_rate=spec['learning_rate'],
-                ).minimize(
-                    loss=self.losses[loss_term_key],
-                    var_list=variables_to_train,
-                    name='optimize_%s' % loss_term_key,
                 )
+                if self.accumulation_steps > 1:
+                    optimize_op = self._build_accumulation(
+                        optimizer, self.losses[loss_term_key], variables_to_train,
+                        name='optimize_%s' % loss_term_key,
+                    )
+                else:
+                    optimize_op = optimizer.apply_gradients(
+                        self._compute_gradients(optimizer, self.losses[loss_term_key],
+                                                variables_to_train),
+                        name='optimize_%s' % loss_term_key,
+                    )
                 optimize_ops.append(optimize_op)
             self._optimize_ops.append(optimize_ops)
             print('Built optimizer for: %s' % ', '.join(loss_terms.keys()))
 
+    def _build_accumulation(self, optimizer, loss, var_list, name):
+        """Sum gradients into accumulators, returns the op applying and resetting them.
+
+        The accumulators are local variables, they are neither trained nor saved.
+        """
+        grads_and_vars = self._compute_gradients(optimizer, loss, var_list)
+        accumulators = [
+            tf.Variable(tf.zeros(v.shape, dtype=v.dtype.base_dtype), trainable=False,
+                        name='gradient_accumulator',
+                        collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            for _, v in grads_and_vars
+        ]
+        self._accumulate_ops += [tf.assign_add(a, g)
+                                 for a, (g, _) in zip(accumulators, grads_and_vars)]
+
+        apply_op = optimizer.apply_gradients(
+            [(a / self.accumulation_steps, v) for a, (_, v) in zip(accumulators, grads_and_vars)],
+            name=name,
+        )
+        with tf.control_dependencies([apply_op]):
+            return tf.group(*[tf.assign(a, tf.zeros_like(a)) for a in accumulators])
+
+    def _build_gradient_ops(self):
+        """Split the optimizers of the learning schedule for data-parallel training.
+
+        `compute_gradients` fetches the gradients of every loss term, the averaged
+        gradients of all workers are then fed to `gradient_placeholders` and applied by
+        running `apply_gradients`.
+        """
+        self.gradients = []
+        self.gradient_placeholders = []
+        self.apply_gradients = [self.increase_train_count]
+        for spec in self._learning_schedule:
+            loss_terms = spec['loss_terms_to_optimize']
+            assert isinstance(loss_terms, dict)
+            for loss_term_key, prefixes in loss_terms.items():
+                optimizer = tf.train.AdamOptimizer(learning_rate=spec['learning_rate'])
+                grads_and_vars = self._compute_gradients(
+                    optimizer, self.losses[loss_term_key], self._variables_to_train(prefixes))
+                placeholders = [tf.placeholder(tf.float32, v.shape) for _, v in grads_and_vars]
+                self.gradients += [g for g, _ in grads_and_vars]
+                self.gradient_placeholders += placeholders
+                self.apply_gradients.append(optimizer.apply_gradients(
+                    zip(placeholders, [v for _, v in grads_and_vars]),
+                    name='optimize_%s' % loss_term_key,
+                ))
+            print('Built data-parallel optimizer for: %s' % ', '.join(loss_terms.keys()))
+
+        self.compute_gradients = {'gradients': self.gradients, 'losses': self.losses}
+        self.compute_gradients_with_summaries = dict(self.compute_gradients,
+                                                     summary=self.summaries)
+
     def build_model(self, predict_only=False):
         outputs = {}
         loss_terms = {}
         metrics = {}
 
-        with tf.variable_scope('hourglass'):
+        with tf.variable_scope('hourglass', custom_getter=self._master_weights_getter):
             # Prepare for Hourglass by downscaling via conv
             with tf.variable_scope('pre'):
                 n = self._hg_num_feature_maps
-                x = self._apply_conv(self.X, num_features=n, kernel_size=7,
+                x = tf.cast(self.X, self._compute_dtype)
+                x = self._apply_conv(x, num_features=n, kernel_size=7,
                                      stride=self._hg_first_layer_stride)
                 x = tf.nn.relu(self._apply_bn(x))
                 x = self._build_residual_block(x, n, 2*n, name='res1')
@@ -129,9 +397,11 @@ class CNN(object):
 
             # Hourglass blocks
             x_prev = x
+            module_heatmaps, module_states = [], []
             for i in range(self._hg_num_modules):
                 with tf.variable_scope('hg_%d' % (i + 1)):
-                    x = self._build_hourglass(x, steps_to_go=4, num_features=self._hg_num_feature_maps)
+                    x = self._build_hourglass(x, steps_to_go=self._hg_depth,
+                                              num_features=self._hg_num_feature_maps)
                     x, h = self._build_hourglass_after(
                         x_prev, x, do_merge=(i < (self._hg_num_modules - 1)),
                     )
@@ -141,6 +411,8 @@ class CNN(object):
                     else:
                         metrics['heatmap%d_mse' % (i + 1)] = None
                     x_prev = x
+                    module_heatmaps.append(h)
+                    module_states.append(x)
             
             if not predict_only:
                 loss_terms['heatmaps_mse'] = tf.reduce_mean([
@@ -155,7 +427,6 @@ class CNN(object):
 
         # Soft-argmax
         x = self._calculate_landmarks(x)
-        self.landmarks = x
 
         with tf.variable_scope('upscale'):
             # Upscale since heatmaps are half-scale of original image
@@ -167,28 +438,71 @@ class CNN(object):
                 metrics['landmarks_mse'] = None
             
             outputs['landmarks'] = x
+            # Eye crop coordinates, whatever the stride of the first layer
+            self.landmarks = x
 
         # Fully-connected layers for radius regression
+        x = self._build_radius(x)
+        outputs['radius'] = x
+
+        if not predict_only:
+            metrics['radius_mse'] = CNN._tf_mse(tf.reshape(x, [-1]), self.Y3)
+            loss_terms['radius_mse'] = 1e-7 * metrics['radius_mse']
+        else:
+            metrics['radius_mse'] = None
+            loss_terms['radius_mse'] = None
+
+        self.radius = x
+
+        if predict_only:
+            self._build_early_exits(module_heatmaps, module_states)
+        
+        # Define outputs
+        return outputs, loss_terms, metrics
+
+    def _build_radius(self, landmarks):
         with tf.variable_scope('radius'):
-            x = tf.contrib.layers.flatten(tf.transpose(x, perm=[0, 2, 1]))
+            x = tf.contrib.layers.flatten(tf.transpose(landmarks, perm=[0, 2, 1]))
             for i in range(3):
                 with tf.variable_scope('fc%d' % (i + 1)):
                     x = tf.nn.relu(self._apply_bn(self._apply_fc(x, 100)))
             with tf.variable_scope('out'):
                 x = self._apply_fc(x, 1)
-            outputs['radius'] = x
-            
-            if not predict_only:
-                metrics['radius_mse'] = CNN._tf_mse(tf.reshape(x, [-1]), self.Y3)
-                loss_terms['radius_mse'] = 1e-7 * metrics['radius_mse']
+        return x
+
+    def _build_early_exits(self, module_heatmaps, module_states):
+        """Heatmaps, landmarks and radius after every hourglass module.
+
+        Intermediate modules share the soft-argmax and the radius layers of the last one.
+        `state` is the module output the next module is built on.
+        """
+        spatial_axes = [1, 2] if self._data_format == 'NHWC' else [2, 3]
+        self.exits = []
+        for i, (h, state) in enumerate(zip(module_heatmaps, module_states)):
+            if i + 1 < self._hg_num_modules:
+                with tf.name_scope('exit_%d' % (i + 1)):
+                    landmarks = self._calculate_landmarks(h) * self._hg_first_layer_stride
+                with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                    radius = self._build_radius(landmarks)
             else:
-                metrics['radius_mse'] = None
-                loss_terms['radius_mse'] = None
+                landmarks, radius = self.landmarks, self.radius
+            self.exits.append({
+                'heatmaps': h,
+                'landmarks': landmarks,
+                'radius': radius,
+                'heatmaps_amax': tf.reduce_max(h, axis=spatial_axes),
+                'state': state,
+            })
+        self.heatmaps_amax = self.exits[-1]['heatmaps_amax']
 
-        self.radius = x
-        
-        # Define outputs
-        return outputs, loss_terms, metrics
+    @staticmethod
+    def _master_weights_getter(getter, *args, **kwargs):
+        """Keep reduced precision variables in float32 and cast them where they are used."""
+        dtype = kwargs.get('dtype')
+        if dtype in (tf.float16, tf.bfloat16):
+            kwargs['dtype'] = tf.float32
+            return tf.cast(getter(*args, **kwargs), dtype)
+        return getter(*args, **kwargs)
 
     def _apply_conv(self, tensor, num_features, kernel_size=3, stride=1):
         return tf.layers.conv2d(
@@ -204,6 +518,22 @@ class CNN(object):
             name='conv',
         )
 
+    def _apply_separable_conv(self, tensor, num_features, kernel_size=3, stride=1):
+        return tf.layers.separable_conv2d(
+            tensor,
+            num_features,
+            kernel_size=kernel_size,
+            strides=stride,
+            padding='SAME',
+            depthwise_initializer=tf.truncated_normal_initializer(mean=0.0, stddev=0.01),
+            pointwise_initializer=tf.truncated_normal_initializer(mean=0.0, stddev=0.01),
+            depthwise_regularizer=tf.contrib.layers.l2_regularizer(1e-4),
+            pointwise_regularizer=tf.contrib.layers.l2_regularizer(1e-4),
+            bias_initializer=tf.zeros_initializer(),
+            data_format=self._data_format_longer,
+            name='conv',
+        )
+
     def _apply_fc(self, tensor, num_outputs):
         return tf.layers.dense(
             tensor,
@@ -227,6 +557,11 @@ class CNN(object):
         return tensor
 
     def _apply_bn(self, tensor):
+        if not self.is_training and self.use_batch_statistics:
+            return self._apply_per_sample_bn(tensor)
+        if tensor.dtype != tf.float32:
+            return self._apply_reduced_precision_bn(tensor)
+        # Explicit scope (the default name) so reused layers find their variables
         return tf.contrib.layers.batch_norm(
             tensor,
             scale=True,
@@ -234,9 +569,51 @@ class CNN(object):
             is_training=self.use_batch_statistics,
             trainable=True,
             data_format=self._data_format,
-            updates_collections=None,
+            updates_collections=None if self.is_training else tf.GraphKeys.UPDATE_OPS,
+            scope='BatchNorm',
         )
 
+    def _apply_per_sample_bn(self, tensor, epsilon=0.001):
+        """Batch norm with the statistics of every sample instead of the whole batch.
+
+        Same as normalizing batches of one sample, so a batch of eye crops gives the
+        results of running them one by one. Uses the variables of `_apply_bn`.
+        """
+        with tf.variable_scope('BatchNorm'):
+            num_channels = tensor.shape[1 if self._data_format == 'NCHW' and
+                                        tensor.shape.ndims == 4 else -1].value
+            beta = tf.get_variable('beta', [num_channels], dtype=tf.float32,
+                                   initializer=tf.zeros_initializer())
+            gamma = tf.get_variable('gamma', [num_channels], dtype=tf.float32,
+                                    initializer=tf.ones_initializer())
+            if tensor.shape.ndims == 4:
+                axes = [2, 3] if self._data_format == 'NCHW' else [1, 2]
+                if self._data_format == 'NCHW':
+                    beta, gamma = tf.reshape(beta, [-1, 1, 1]), tf.reshape(gamma, [-1, 1, 1])
+            else:
+                axes = []
+            x = tf.cast(tensor, tf.float32)
+            mean, variance = tf.nn.moments(x, axes, keep_dims=True)
+            x = tf.nn.batch_normalization(x, mean, variance, beta, gamma, epsilon)
+            return tf.cast(x, tensor.dtype)
+
+    def _apply_reduced_precision_bn(self, tensor):
+        """Batch norm of float16/bfloat16 inputs with float32 parameters and statistics.
+
+        Uses the core layer, which supports reduced precision inputs, with the variable
+        names of `tf.contrib.layers.batch_norm` so checkpoints work in every precision.
+        """
+        axis = 1 if self._data_format == 'NCHW' and tensor.shape.ndims == 4 else -1
+        # Same decay and epsilon as the contrib layer, so the moving statistics match
+        layer = tf.layers.BatchNormalization(axis=axis, momentum=0.999, epsilon=0.001,
+                                             center=True, scale=True, name='BatchNorm')
+        output = layer.apply(tensor, training=self.use_batch_statistics)
+        if not self.is_training:
+            return output
+        # Update the moving statistics in place, like updates_collections=None
+        with tf.control_dependencies(layer.updates):
+            return tf.identity(output)
+
     def _build_residual_block(self, x, num_in, num_out, name='res_block'):
         with tf.variable_scope(name):
             half_num_out = max(int(num_out/2), 1)
@@ -246,7 +623,10 @@ class CNN(object):
                 c = self._apply_conv(c, num_features=half_num_out, kernel_size=1, stride=1)
             with tf.variable_scope('conv2'):
                 c = tf.nn.relu(self._apply_bn(c))
-                c = self._apply_conv(c, num_features=half_num_out, kernel_size=3, stride=1)
+                if self._hg_separable_convs:
+                    c = self._apply_separable_conv(c, num_features=half_num_out, kernel_size=3)
+                else:
+                    c = self._apply_conv(c, num_features=half_num_out, kernel_size=3, stride=1)
             with tf.variable_scope('conv3'):
                 c = tf.nn.relu(self._apply_bn(c))
                 c = self._apply_conv(c, num_features=num_out, kernel_size=1, stride=1)
@@ -294,6 +674,8 @@ class CNN(object):
                   )
             if self._data_format == 'NCHW':  # convert back from NHWC
                 up2 = tf.transpose(up2, (0, 3, 1, 2))
+            # Bilinear resizing always outputs float32
+            up2 = tf.cast(up2, up1.dtype)
 
         return up1 + up2
 
@@ -318,7 +700,8 @@ class CNN(object):
                 with tf.variable_scope('x'):
                     x_now = self._apply_conv(x_now, self._hg_num_feature_maps, kernel_size=1, stride=1)
                 x_next += x_prev + x_hmaps
-        return x_next, h
+        # Losses and the soft-argmax use float32 heatmaps
+        return x_next, tf.cast(h, tf.float32)
 
     _softargmax_coords = None
 
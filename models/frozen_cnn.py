@@ -0,0 +1,86 @@
+"""Export the CNN as a frozen inference graph and run it without rebuilding the model.
+
+The frozen graph has the trained variables as constants, only the ops needed by the
+landmarks, radius, heatmap peaks and (optionally) heatmaps outputs and constant-folded
+subgraphs. Batch norm can only be folded into the convolutions when it normalizes with
+the moving statistics (`use_batch_statistics=False`); the default models normalize with
+the statistics of every input crop, which depend on the input and are kept as ops.
+"""
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from models.cnn import CNN, load_model_config
+
+INPUT_NAME = 'eye'
+OUTPUT_NAMES = ('landmarks', 'radius', 'heatmaps_amax', 'heatmaps')
+
+
+def input_shape(eye_shape, data_format):
+    """Shape of the input placeholder, batches of eye crops of `eye_shape` (height, width)."""
+    if data_format == 'NHWC':
+        return [None] + list(eye_shape) + [1]
+    return [None, 1] + list(eye_shape)
+
+
+def export_frozen_graph(checkpoint_path, output_path, eye_shape, data_format='NHWC',
+                        heatmaps=True, use_batch_statistics=True):
+    """Freeze the model of `checkpoint_path` into a GraphDef saved at `output_path`."""
+    output_names = list(OUTPUT_NAMES if heatmaps else OUTPUT_NAMES[:3])
+    with tf.Graph().as_default() as graph:
+        eye = tf.placeholder(tf.float32, input_shape(eye_shape, data_format), name=INPUT_NAME)
+        model = CNN(eye, eye_shape, None, data_format=data_format, predict_only=True,
+                    model_config=load_model_config(checkpoint_path),
+                    use_batch_statistics=use_batch_statistics)
+        tf.identity(model.landmarks, name='landmarks')
+        tf.identity(model.radius, name='radius')
+        tf.identity(model.heatmaps_amax, name='heatmaps_amax')
+        tf.identity(model.heatmaps, name='heatmaps')
+
+        with tf.Session() as sess:
+            tf.train.Saver().restore(sess, checkpoint_path)
+            graph_def = tf.graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), output_names)
+
+    transforms = ['strip_unused_nodes', 'fold_constants(ignore_errors=true)']
+    if not use_batch_statistics:
+        transforms += ['fold_batch_norms', 'fold_old_batch_norms',
+                       'fold_constants(ignore_errors=true)']
+    graph_def = TransformGraph(graph_def, [INPUT_NAME], output_names, transforms)
+    with tf.gfile.GFile(output_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print('Frozen graph with %d ops saved at %s' % (len(graph_def.node), output_path))
+    return output_names
+
+
+class FrozenCNN(object):
+    """Run a frozen graph exported by `export_frozen_graph`."""
+    def __init__(self, path, config=None):
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self._eye = self.graph.get_tensor_by_name(INPUT_NAME + ':0')
+        self._outputs = {name: self.graph.get_tensor_by_name(name + ':0')
+                         for name in OUTPUT_NAMES
+                         if any(node.name == name for node in graph_def.node)}
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+    def predict(self, eyes):
+        """Landmarks, heatmaps (None if not exported) and radius of a batch of eye crops."""
+        eyes = np.reshape(eyes, [-1] + self._eye.shape.as_list()[1:])
+        outputs = self.sess.run(self._outputs, feed_dict={self._eye: eyes})
+        return outputs['landmarks'], outputs.get('heatmaps'), outputs['radius']
+
+    def predict_eyes(self, eyes, heatmaps=False):
+        """Same outputs as `CNN.predict_eyes` for a stack of eye crops."""
+        eyes = np.reshape(eyes, [-1] + self._eye.shape.as_list()[1:])
+        fetches = {name: tensor for name, tensor in self._outputs.items()
+                   if heatmaps or name != 'heatmaps'}
+        return self.sess.run(fetches, feed_dict={self._eye: eyes})
+
+    def close(self):
+        self.sess.close()
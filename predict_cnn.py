@@ -4,7 +4,7 @@ from __future__ import division, print_function, absolute_import
 import util.util as util
 
 from data_sources.data_source import DataSource
-from models.cnn import CNN
+from models.cnn import CNN, load_model_config
 from learning.trainer import Trainer
 
 import argparse
@@ -34,7 +34,8 @@ def main(args):
         }
     ]
     model = CNN(datasource.tensors, datasource.x_shape, learning_schedule,
-                data_format=args.data_format)
+                data_format=args.data_format,
+                model_config=load_model_config(args.model_checkpoint))
     
     # Get evaluator
     evaluator = Trainer(model, model_checkpoint=args.model_checkpoint)
@@ -13,6 +13,22 @@ parser.add_argument('--input-path', type=str, default='data/', required=True)
 parser.add_argument('--eye-shape', type=int, nargs="+", default=[60, 90])
 parser.add_argument('--heatmap-scale', type=float, default=1)
 parser.add_argument('--data-format', type=str, default='NCHW')
+parser.add_argument('--no-heatmaps', action='store_true',
+                    help='Store only landmarks and sigma, heatmaps are rendered while training.')
+parser.add_argument('--no-augmentation', action='store_true',
+                    help='Only segment eyes, to be augmented online by train_cnn.py.')
+parser.add_argument('--output-format', type=str, default='tfrecord',
+                    help='pickle (one file per sample) or tfrecord (sharded).')
+parser.add_argument('--annotation-index', type=str, default=None,
+                    help='Pre-parsed annotations file (default: annotations.npz in --input-path).')
+parser.add_argument('--no-annotation-index', action='store_true',
+                    help='Parse each .json file instead of using the annotation index.')
+parser.add_argument('--no-resume', action='store_true',
+                    help='Reprocess everything instead of skipping stems listed in the manifest.')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of processes used to preprocess the data.')
+parser.add_argument('--seed', type=int, default=0,
+                    help='Base seed for the augmentation RNG (combined with a hash of each stem).')
 
 if __name__ == '__main__':
     args = parser.parse_args()
@@ -20,23 +36,25 @@ if __name__ == '__main__':
     if args.dataset == 'unityEyes':
         unityeyes = UnityEyes(
             data_format=args.data_format,
-            generate_heatmaps=True,
+            generate_heatmaps=not args.no_heatmaps,
             eye_image_shape=tuple(args.eye_shape),
             heatmaps_scale=args.heatmap_scale,
             input_path=args.input_path,
-            output_path=args.output_path
+            output_path=args.output_path,
+            output_format=args.output_format
         )
 
-        unityeyes.set_augmentation_range('translation', 2.0, 10.0)
-        unityeyes.set_augmentation_range('rotation', 1.0, 10.0)
-        unityeyes.set_augmentation_range('intensity', 0.5, 20.0)
-        unityeyes.set_augmentation_range('blur', 0.1, 1.0)
-        unityeyes.set_augmentation_range('scale', 0.01, 0.1)
-        unityeyes.set_augmentation_range('rescale', 1.0, 0.5)
-        unityeyes.set_augmentation_range('num_line', 0.0, 2.0)
-        unityeyes.set_augmentation_range('heatmap_sigma', 7.5, 2.5)
+        if args.no_augmentation:
+            for augmentation_type in ['translation', 'rotation', 'intensity', 'blur', 'scale',
+                                      'num_line']:
+                unityeyes.set_augmentation_range(augmentation_type, 0.0, 0.0)
+            unityeyes.set_augmentation_range('rescale', 1.0, 1.0)
 
-        unityeyes.preprocess_data()
+        if not args.no_annotation_index:
+            unityeyes.load_annotation_index(args.annotation_index)
+
+        unityeyes.preprocess_data(num_workers=args.workers, seed=args.seed,
+                                  resume=not args.no_resume)
     else:
         raise NotImplementedError
 
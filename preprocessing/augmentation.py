@@ -0,0 +1,217 @@
+"""
+Augmentation of eye images, shared by offline preprocessing and online training.
+
+`augment_sample` applies the augmentations (rotation, scale, translation, line drawing,
+rescale, intensity noise and blur) and moves landmarks and radius with the image.
+`UnityEyes.preprocess_entry` calls it while segmenting eyes from the full renders, and
+`Augmenter` calls it on already segmented eye images while training, so every epoch sees
+different pixels. Heatmaps should then be rendered from the landmarks.
+"""
+
+import multiprocessing
+import cv2 as cv
+import numpy as np
+
+# Default (easy, hard) range of every augmentation type
+AUGMENTATION_RANGES = {
+    'translation': (2.0, 10.0),
+    'rotation': (1.0, 10.0),
+    'intensity': (0.5, 20.0),
+    'blur': (0.1, 1.0),
+    'scale': (0.01, 0.1),
+    'rescale': (1.0, 0.5),
+    'num_line': (0.0, 2.0),
+    'heatmap_sigma': (7.5, 2.5),
+}
+
+
+def value_from_type(augmentation_ranges, difficulty, augmentation_type):
+    """Value of an augmentation type at `difficulty`, within its (easy, hard) range."""
+    easy_value, hard_value = augmentation_ranges[augmentation_type]
+    value = (hard_value - easy_value) * difficulty + easy_value
+    value = (np.clip(value, easy_value, hard_value)
+             if easy_value < hard_value
+             else np.clip(value, hard_value, easy_value))
+    return value
+
+
+class AugmentationRanges(object):
+    """Difficulty and augmentation ranges, see `AUGMENTATION_RANGES`."""
+
+    def __init__(self):
+        self._difficulty = 0.0
+        self._augmentation_ranges = dict(AUGMENTATION_RANGES)
+
+    def set_difficulty(self, difficulty):
+        """Set difficulty of training data."""
+        assert isinstance(difficulty, float)
+        assert 0.0 <= difficulty <= 1.0
+        self._difficulty = difficulty
+
+    def set_augmentation_range(self, augmentation_type, easy_value, hard_value):
+        """Set 'range' for a known augmentation type."""
+        assert isinstance(augmentation_type, str)
+        assert augmentation_type in self._augmentation_ranges
+        assert isinstance(easy_value, float) or isinstance(easy_value, int)
+        assert isinstance(hard_value, float) or isinstance(hard_value, int)
+        self._augmentation_ranges[augmentation_type] = (easy_value, hard_value)
+
+    def value_from_type(self, augmentation_type):
+        return value_from_type(self._augmentation_ranges, self._difficulty, augmentation_type)
+
+
+class Augmenter(AugmentationRanges):
+    """Augment batches of (eye, landmarks, radius) in threads or in a process pool."""
+
+    def __init__(self,
+                 data_format='NHWC',
+                 num_parallel_calls=8,
+                 num_workers=0,
+                 curriculum_steps=None,
+                 batches_per_step=1,
+                 seed=7):
+        super().__init__()
+        self.data_format = data_format.upper()
+        assert self.data_format == 'NHWC' or self.data_format == 'NCHW'
+
+        # Number of batches augmented concurrently by tf.data
+        self.num_parallel_calls = num_parallel_calls
+
+        # Difficulty grows linearly from 0 to 1 during `curriculum_steps` steps of
+        # `batches_per_step` batches
+        self._curriculum_steps = curriculum_steps
+        self._batches_per_step = batches_per_step
+
+        # The random values of a batch only depend on the seed and the batch index
+        self.seed = seed
+
+        # Forking a process that already runs a TF session is not safe, so spawn them
+        self._pool = None
+        if num_workers > 0:
+            self._pool = multiprocessing.get_context('spawn').Pool(num_workers)
+
+    def augment_batch(self, batch_index, eyes, landmarks, radius):
+        """Augment the batch `batch_index`, meant to be called from `tf.py_func`.
+
+        Also returns the heatmap sigma of the batch difficulty for every sample.
+        """
+        difficulty = self._difficulty
+        if self._curriculum_steps:
+            step = batch_index // self._batches_per_step
+            difficulty = float(min(1.0, step / self._curriculum_steps))
+        random = np.random.RandomState([self.seed, int(batch_index)])
+        seeds = random.randint(2**31 - 1, size=len(eyes))
+        args = [(eyes[i], landmarks[i], radius[i], self._augmentation_ranges,
+                 difficulty, seeds[i], self.data_format) for i in range(len(eyes))]
+        if self._pool is not None:
+            results = self._pool.starmap(augment_sample, args)
+        else:
+            results = [augment_sample(*a) for a in args]
+
+        eyes, landmarks, radius, _ = zip(*results)
+        heatmap_sigma = np.full(
+            len(eyes), value_from_type(self._augmentation_ranges, difficulty, 'heatmap_sigma'),
+            dtype=np.float32)
+        return (np.stack(eyes), np.stack(landmarks), np.asarray(radius, dtype=np.float32),
+                heatmap_sigma)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+def augment_sample(eye, landmarks, radius, augmentation_ranges, difficulty, seed,
+                   data_format='NHWC', crop_mat=None, output_shape=None):
+    """Augment one eye image together with its landmarks and radius.
+
+    `eye` is a segmented eye image in [-1, 1] or, with `crop_mat`, a uint8 image from
+    which the eye of `output_shape` is cropped by that 3x3 transform together with the
+    random one. `seed` can also be a `np.random.RandomState`. Returns the eye in [-1, 1],
+    the landmarks and radius in eye image coordinates and the random rotation (3x3),
+    to rotate gaze directions.
+    """
+    random = seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
+
+    def value(augmentation_type):
+        return value_from_type(augmentation_ranges, difficulty, augmentation_type)
+
+    def noisy_value(augmentation_type):
+        return random.normal() * value(augmentation_type)
+
+    eye = np.squeeze(eye)
+    if eye.dtype != np.uint8:
+        eye = np.clip((eye + 1.0) * (255.0 / 2.0), 0, 255).astype(np.uint8)
+    if crop_mat is None:
+        crop_mat = np.eye(3)
+        output_shape = eye.shape
+    oh, ow = output_shape
+
+    # Rotate and scale around the eye image centre, then translate (with noise)
+    rotation_noise = noisy_value('rotation')
+    scale = 1. + noisy_value('scale')
+    noise_mat = np.asmatrix(np.eye(3))
+    noise_mat[:2, :] = cv.getRotationMatrix2D((0.5 * ow, 0.5 * oh), rotation_noise, scale)
+    noise_mat[0, 2] += noisy_value('translation')  # x
+    noise_mat[1, 2] += noisy_value('translation')  # y
+    rotate_mat = np.asmatrix(np.eye(3))
+    rotate_mat[:2, :2] = noise_mat[:2, :2] / scale
+
+    transform_mat = noise_mat * np.asmatrix(crop_mat)
+    eye = cv.warpAffine(eye, transform_mat[:2, :], (ow, oh), borderMode=cv.BORDER_REPLICATE)
+
+    landmarks = np.pad(landmarks, ((0, 0), (0, 1)), 'constant', constant_values=1)
+    landmarks = np.asarray(np.dot(landmarks, transform_mat.T))
+    radius = radius * scale
+
+    # Draw line randomly
+    num_line_noise = int(np.round(noisy_value('num_line')))
+    if num_line_noise > 0:
+        line_rand_nums = random.rand(5 * num_line_noise)
+        for i in range(num_line_noise):
+            j = 5 * i
+            lx0, ly0 = int(ow * line_rand_nums[j]), oh
+            lx1, ly1 = ow, int(oh * line_rand_nums[j + 1])
+            direction = line_rand_nums[j + 2]
+            if direction < 0.25:
+                lx1 = ly0 = 0
+            elif direction < 0.5:
+                lx1 = 0
+            elif direction < 0.75:
+                ly0 = 0
+            line_colour = int(255 * line_rand_nums[j + 3])
+            eye = cv.line(eye, (lx0, ly0), (lx1, ly1),
+                          color=(line_colour, line_colour, line_colour),
+                          thickness=int(6*line_rand_nums[j + 4]), lineType=cv.LINE_AA)
+
+    # Rescale image if required
+    rescale_max = value('rescale')
+    if rescale_max < 1.0:
+        rescale_noise = random.uniform(low=rescale_max, high=1.0)
+        interpolation = cv.INTER_CUBIC
+        eye = cv.resize(eye, dsize=(0, 0), fx=rescale_noise, fy=rescale_noise,
+                        interpolation=interpolation)
+        eye = cv.equalizeHist(eye)
+        eye = cv.resize(eye, dsize=(ow, oh), interpolation=interpolation)
+
+    # Add rgb noise to eye image
+    intensity_noise = int(value('intensity'))
+    if intensity_noise > 0:
+        eye = eye.astype(np.int16)
+        eye += random.randint(low=-intensity_noise, high=intensity_noise,
+                              size=eye.shape).astype(np.int16)
+        cv.normalize(eye, eye, alpha=0, beta=255, norm_type=cv.NORM_MINMAX)
+        eye = eye.astype(np.uint8)
+
+    # Add blur to eye image
+    blur_noise = noisy_value('blur')
+    if blur_noise > 0:
+        eye = cv.GaussianBlur(eye, (7, 7), 0.5 + np.abs(blur_noise))
+
+    # Histogram equalization and preprocessing for NN
+    eye = cv.equalizeHist(eye)
+    eye = eye.astype(np.float32)
+    eye *= 2.0 / 255.0
+    eye -= 1.0
+    eye = np.expand_dims(eye, -1 if data_format == 'NHWC' else 0)
+    return eye, landmarks.astype(np.float32), np.float32(radius), rotate_mat
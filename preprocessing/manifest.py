@@ -0,0 +1,73 @@
+"""Manifest of preprocessed stems, used to resume and incrementally update preprocessing."""
+
+import os
+import time
+import hashlib
+import ujson
+
+
+def file_hash(*paths):
+    """MD5 of the contents of the given files (missing files are ignored)."""
+    md5 = hashlib.md5()
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                md5.update(f.read())
+    return md5.hexdigest()
+
+
+def stem_seed(file_stem):
+    """32-bit seed derived from a stem, independent of its position among the stems."""
+    return int(hashlib.md5(file_stem.encode('utf-8')).hexdigest()[:8], 16)
+
+
+class Manifest(object):
+    """Per-stem record of source hashes, rejections and outputs.
+
+    Each stem record has the form:
+        {'hash': str, 'rejected': bool, 'output': str}
+    where `output` is the basename of the TFRecord shard holding the stem, or None for
+    rejected stems and pickle outputs. `outputs` maps every shard to the stems it holds,
+    in record order. Records are only reused if the preprocessing `config` did not change.
+
+    Updates are written at most every `save_secs` seconds, `save` has to be called once
+    all stems are done.
+    """
+    def __init__(self, path, config, save_secs=30):
+        self._path = path
+        # Round trip through JSON so tuples compare equal to the saved lists
+        self.config = ujson.loads(ujson.dumps(config))
+        self.stems = {}
+        self.outputs = {}
+        self._save_secs = save_secs
+        self._last_save = time.time()
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                data = ujson.load(f)
+            # Manifests written per shard have no 'stems'
+            if data.get('config') == self.config and 'stems' in data:
+                self.stems = data['stems']
+                self.outputs = data['outputs']
+            else:
+                print('preprocessing config changed, ignoring manifest %s' % path)
+
+    def clear(self):
+        self.stems = {}
+        self.outputs = {}
+
+    def update(self, stem_records, output=None, output_stems=None):
+        """Record finished stems and the shard holding them, a crash loses at most
+        `save_secs` of finished stems."""
+        self.stems.update(stem_records)
+        if output is not None:
+            self.outputs[output] = output_stems
+        if time.time() - self._last_save >= self._save_secs:
+            self.save()
+
+    def save(self):
+        self._last_save = time.time()
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            ujson.dump({'config': self.config, 'stems': self.stems, 'outputs': self.outputs}, f)
+        os.replace(tmp_path, self._path)
@@ -11,26 +11,74 @@ import numpy as np
 import ujson
 import pickle
 import time
+import itertools
+import multiprocessing
 
 from preprocessing.preprocessor import Preprocessor
+from preprocessing.augmentation import AugmentationRanges, augment_sample
 import util.gaze as gaze
 import util.heatmap as heatmap
 import util.util as util
+import util.records as records
+from preprocessing.manifest import Manifest, file_hash, stem_seed
 
+# Annotations used from each UnityEyes .json file
+ANNOTATION_KEYS = ('interior_margin_2d', 'caruncle_2d', 'iris_2d', 'head_pose', 'look_vec')
+ANNOTATION_INDEX_FILENAME = 'annotations.npz'
+MANIFEST_FILENAME = 'manifest.json'
 
-class UnityEyes(Preprocessor):
+# Stages each entry goes through in `UnityEyes.preprocess_data`, in order
+PIPELINE_STAGES = ('manifest', 'metadata', 'decode', 'segment', 'save')
+
+
+def _new_stage_stats():
+    return {stage: {'accepted': 0, 'rejected': 0, 'time': 0.0} for stage in PIPELINE_STAGES}
+
+
+def _record_stage(stats, stage, accepted, t):
+    """Account an entry going through `stage` since `t`, returns the current time."""
+    now = time.time()
+    stats[stage]['accepted' if accepted else 'rejected'] += 1
+    stats[stage]['time'] += now - t
+    return now
+
+
+def parse_tuples(tuple_strings, num_values=3):
+    """Parse '(x, y, z)' strings into a (N, num_values) float array in one pass."""
+    if isinstance(tuple_strings, str):
+        tuple_strings = [tuple_strings]
+    values = ','.join(tuple_strings).replace('(', '').replace(')', '')
+    return np.array(values.split(','), dtype=np.float64).reshape(-1, num_values)
+
+
+def parse_annotations(json_data):
+    """Parse the annotations of an UnityEyes .json file into float arrays."""
+    return {
+        'interior_margin_2d': parse_tuples(json_data['interior_margin_2d']),
+        'caruncle_2d': parse_tuples(json_data['caruncle_2d']),
+        'iris_2d': parse_tuples(json_data['iris_2d']),
+        'head_pose': parse_tuples(json_data['head_pose'])[0],
+        'look_vec': parse_tuples(json_data['eye_details']['look_vec'], num_values=4)[0],
+    }
+
+
+class UnityEyes(Preprocessor, AugmentationRanges):
     """UnityEyes data loading class."""
 
     def __init__(self,
                  generate_heatmaps=False,
                  heatmaps_scale=1.0,
+                 output_format='tfrecord',
                  **kwargs):
         
-        # Call parent class constructor
-        super().__init__(**kwargs)
+        # Call parent class constructors
+        Preprocessor.__init__(self, **kwargs)
+        AugmentationRanges.__init__(self)
 
         # Cache some parameters
         self._heatmaps_scale = heatmaps_scale
+        assert output_format == 'pickle' or output_format == 'tfrecord'
+        self._output_format = output_format
 
         # Create global index over all specified keys
         self._file_stems = sorted([p[:-5] for p in os.listdir(self._input_path)
@@ -38,82 +86,50 @@ class UnityEyes(Preprocessor):
         self._num_entries = len(self._file_stems)
         self._current_index = 0
 
-        # Define bounds for noise values for different augmentation types
-        self._difficulty = 0.0
-        self._augmentation_ranges = {  # (easy, hard)
-            'translation': (2.0, 10.0),
-            'rotation': (0.1, 2.0),
-            'intensity': (0.5, 20.0),
-            'blur': (0.1, 1.0),
-            'scale': (0.01, 0.1),
-            'rescale': (1.0, 0.2),
-            'num_line': (0.0, 2.0),
-            'heatmap_sigma': (5.0, 2.5),
-        }
+        # Seeded per stem by `_preprocess_shard`
+        self._random = np.random.RandomState()
         self._generate_heatmaps = generate_heatmaps
 
+        # Pre-parsed annotations, see `load_annotation_index`
+        self._annotation_index = None
+        self._annotation_positions = None
+
 
     @property
     def num_entries(self):
         """Number of entries in this data source."""
         return self._num_entries
 
-    def set_difficulty(self, difficulty):
-        """Set difficulty of training data."""
-        assert isinstance(difficulty, float)
-        assert 0.0 <= difficulty <= 1.0
-        self._difficulty = difficulty
-
-    def set_augmentation_range(self, augmentation_type, easy_value, hard_value):
-        """Set 'range' for a known augmentation type."""
-        assert isinstance(augmentation_type, str)
-        assert augmentation_type in self._augmentation_ranges
-        assert isinstance(easy_value, float) or isinstance(easy_value, int)
-        assert isinstance(hard_value, float) or isinstance(hard_value, int)
-        self._augmentation_ranges[augmentation_type] = (easy_value, hard_value)
+    @staticmethod
+    def is_frontal(annotations):
+        """Check from metadata only whether the head pose is almost frontal."""
+        h_pitch, h_yaw, _ = annotations['head_pose']
+        if h_pitch > 180.0:  # Need to correct pitch
+            h_pitch -= 360.0
+        h_yaw -= 180.0  # Need to correct yaw
+        return abs(h_pitch) <= 20 and abs(h_yaw) <= 20
 
     def preprocess_entry(self, entry):
         """Use annotations to segment eyes and calculate gaze direction."""
         full_image = entry['full_image']
-        json_data = entry['json_data']
+        annotations = entry['annotations']
         res = {}
 
         ih, iw = full_image.shape
         iw_2, ih_2 = 0.5 * iw, 0.5 * ih
         oh, ow = self._eye_image_shape
 
-        def process_coords(coords_list):
-            coords = [eval(l) for l in coords_list]
-            return np.array([(x, ih-y, z) for (x, y, z) in coords])
-
-        interior_landmarks = process_coords(json_data['interior_margin_2d'])
-        caruncle_landmarks = process_coords(json_data['caruncle_2d'])
-        iris_landmarks = process_coords(json_data['iris_2d'])
-
-        random_multipliers = []
+        def process_coords(coords):
+            coords = np.array(coords)
+            coords[:, 1] = ih - coords[:, 1]
+            return coords
 
-        def value_from_type(augmentation_type):
-            # Scale to be in range
-            easy_value, hard_value = self._augmentation_ranges[augmentation_type]
-            value = (hard_value - easy_value) * self._difficulty + easy_value
-            value = (np.clip(value, easy_value, hard_value)
-                     if easy_value < hard_value
-                     else np.clip(value, hard_value, easy_value))
-            return value
-
-        def noisy_value_from_type(augmentation_type):
-            # Get normal distributed random value
-            if len(random_multipliers) == 0:
-                random_multipliers.extend(
-                        list(np.random.normal(size=(len(self._augmentation_ranges),))))
-            return random_multipliers.pop() * value_from_type(augmentation_type)
+        interior_landmarks = process_coords(annotations['interior_margin_2d'])
+        caruncle_landmarks = process_coords(annotations['caruncle_2d'])
+        iris_landmarks = process_coords(annotations['iris_2d'])
 
         # Only select almost frontal images
-        h_pitch, h_yaw, _ = eval(json_data['head_pose'])
-        if h_pitch > 180.0:  # Need to correct pitch
-            h_pitch -= 360.0
-        h_yaw -= 180.0  # Need to correct yaw
-        if abs(h_pitch) > 20 or abs(h_yaw) > 20:
+        if not self.is_frontal(annotations):
             return None
 
         # Prepare to segment eye image
@@ -127,103 +143,22 @@ class UnityEyes(Preprocessor):
         translate_mat = np.asmatrix(np.eye(3))
         translate_mat[:2, 2] = [[-iw_2], [-ih_2]]
 
-        # Rotate eye image if requested
-        rotate_mat = np.asmatrix(np.eye(3))
-        rotation_noise = noisy_value_from_type('rotation')
-        if rotation_noise > 0:
-            rotate_angle = np.radians(rotation_noise)
-            cos_rotate = np.cos(rotate_angle)
-            sin_rotate = np.sin(rotate_angle)
-            rotate_mat[0, 0] = cos_rotate
-            rotate_mat[0, 1] = -sin_rotate
-            rotate_mat[1, 0] = sin_rotate
-            rotate_mat[1, 1] = cos_rotate
-
-        # Scale image to fit output dimensions (with a little bit of noise)
+        # Scale image to fit output dimensions
         scale_mat = np.asmatrix(np.eye(3))
-        scale = 1. + noisy_value_from_type('scale')
-        scale_inv = 1. / scale
-        np.fill_diagonal(scale_mat, ow / eye_width * scale)
+        np.fill_diagonal(scale_mat, ow / eye_width)
         original_eyeball_radius = 71.7593
         eyeball_radius = original_eyeball_radius * scale_mat[0, 0]  # See: https://goo.gl/ZnXgDE
-        res['radius'] = np.float32(eyeball_radius)
 
         # Re-centre eye image such that eye fits (based on determined `eye_middle`)
         recentre_mat = np.asmatrix(np.eye(3))
-        recentre_mat[0, 2] = iw/2 - eye_middle[0] + 0.5 * eye_width * scale_inv
-        recentre_mat[1, 2] = ih/2 - eye_middle[1] + 0.5 * oh / ow * eye_width * scale_inv
-        recentre_mat[0, 2] += noisy_value_from_type('translation')  # x
-        recentre_mat[1, 2] += noisy_value_from_type('translation')  # y
-
-        # Apply transforms
-        transform_mat = recentre_mat * scale_mat * rotate_mat * translate_mat
-        eye = cv.warpAffine(full_image, transform_mat[:2, :3], (ow, oh))
+        recentre_mat[0, 2] = iw/2 - eye_middle[0] + 0.5 * eye_width
+        recentre_mat[1, 2] = ih/2 - eye_middle[1] + 0.5 * oh / ow * eye_width
+        crop_mat = recentre_mat * scale_mat * translate_mat
 
-        # Convert look vector to gaze direction in polar angles
-        look_vec = np.array(eval(json_data['eye_details']['look_vec']))[:3]
+        # Select landmark coordinates
+        look_vec = np.array(annotations['look_vec'][:3])
         look_vec[0] = -look_vec[0]
         original_gaze = gaze.vector_to_pitchyaw(look_vec.reshape((1, 3))).flatten()
-        look_vec = rotate_mat * look_vec.reshape(3, 1)
-        _gaze = gaze.vector_to_pitchyaw(look_vec.reshape((1, 3))).flatten()
-        if _gaze[1] > 0.0:
-            _gaze[1] = np.pi - _gaze[1]
-        elif _gaze[1] < 0.0:
-            _gaze[1] = -(np.pi + _gaze[1])
-        res['gaze'] = _gaze.astype(np.float32)
-
-        # Draw line randomly
-        num_line_noise = int(np.round(noisy_value_from_type('num_line')))
-        if num_line_noise > 0:
-            line_rand_nums = np.random.rand(5 * num_line_noise)
-            for i in range(num_line_noise):
-                j = 5 * i
-                lx0, ly0 = int(ow * line_rand_nums[j]), oh
-                lx1, ly1 = ow, int(oh * line_rand_nums[j + 1])
-                direction = line_rand_nums[j + 2]
-                if direction < 0.25:
-                    lx1 = ly0 = 0
-                elif direction < 0.5:
-                    lx1 = 0
-                elif direction < 0.75:
-                    ly0 = 0
-                line_colour = int(255 * line_rand_nums[j + 3])
-                eye = cv.line(eye, (lx0, ly0), (lx1, ly1),
-                              color=(line_colour, line_colour, line_colour),
-                              thickness=int(6*line_rand_nums[j + 4]), lineType=cv.LINE_AA)
-
-        # Rescale image if required
-        rescale_max = value_from_type('rescale')
-        if rescale_max < 1.0:
-            rescale_noise = np.random.uniform(low=rescale_max, high=1.0)
-            interpolation = cv.INTER_CUBIC
-            eye = cv.resize(eye, dsize=(0, 0), fx=rescale_noise, fy=rescale_noise,
-                            interpolation=interpolation)
-            eye = cv.equalizeHist(eye)
-            eye = cv.resize(eye, dsize=(ow, oh), interpolation=interpolation)
-
-        # Add rgb noise to eye image
-        intensity_noise = int(value_from_type('intensity'))
-        if intensity_noise > 0:
-            eye = eye.astype(np.int16)
-            eye += np.random.randint(low=-intensity_noise, high=intensity_noise,
-                                     size=eye.shape, dtype=np.int16)
-            cv.normalize(eye, eye, alpha=0, beta=255, norm_type=cv.NORM_MINMAX)
-            eye = eye.astype(np.uint8)
-
-        # Add blur to eye image
-        blur_noise = noisy_value_from_type('blur')
-        if blur_noise > 0:
-            eye = cv.GaussianBlur(eye, (7, 7), 0.5 + np.abs(blur_noise))
-
-        # Histogram equalization and preprocessing for NN
-        eye = cv.equalizeHist(eye)
-        eye = eye.astype(np.float32)
-        eye *= 2.0 / 255.0
-        eye -= 1.0
-        eye = np.expand_dims(eye, -1 if self.data_format == 'NHWC' else 0)
-        res['eye'] = eye
-
-        # Select and transform landmark coordinates
         iris_centre = np.asarray([
             iw_2 + original_eyeball_radius * -np.cos(original_gaze[0]) * np.sin(original_gaze[1]),
             ih_2 + original_eyeball_radius * -np.sin(original_gaze[0]),
@@ -233,55 +168,337 @@ class UnityEyes(Preprocessor):
                                     iris_centre.reshape((1, 2)),
                                     [[iw_2, ih_2]],  # Eyeball centre
                                     ])  # 18 in total
-        landmarks = np.asmatrix(np.pad(landmarks, ((0, 0), (0, 1)), 'constant',
-                                       constant_values=1))
-        landmarks = np.asarray(landmarks * transform_mat.T)
-        landmarks = landmarks[:, :2]  # We only need x, y
-        res['landmarks'] = landmarks.astype(np.float32)
+
+        # Crop and augment the eye, moving landmarks and radius with it
+        eye, landmarks, radius, rotate_mat = augment_sample(
+            full_image, landmarks, eyeball_radius, self._augmentation_ranges,
+            self._difficulty, self._random, self.data_format, crop_mat=crop_mat,
+            output_shape=(oh, ow))
+        res['eye'] = eye
+        res['landmarks'] = landmarks
+        res['radius'] = radius
+
+        # Convert look vector to gaze direction in polar angles
+        look_vec = rotate_mat * look_vec.reshape(3, 1)
+        _gaze = gaze.vector_to_pitchyaw(look_vec.reshape((1, 3))).flatten()
+        if _gaze[1] > 0.0:
+            _gaze[1] = np.pi - _gaze[1]
+        elif _gaze[1] < 0.0:
+            _gaze[1] = -(np.pi + _gaze[1])
+        res['gaze'] = _gaze.astype(np.float32)
+
+        # Keep sigma so heatmaps can also be rendered later from the landmarks
+        heatmap_sigma = self.value_from_type('heatmap_sigma')
+        res['heatmap_sigma'] = np.float32(heatmap_sigma)
 
         # Generate heatmaps if necessary
         if self._generate_heatmaps:
             # Should be half-scale (compared to eye image)
-            res['heatmaps'] = np.asarray([
-                heatmap.gaussian_2d(
-                    shape=(self._heatmaps_scale*oh, self._heatmaps_scale*ow),
-                    centre=self._heatmaps_scale*landmark,
-                    sigma=value_from_type('heatmap_sigma'),
-                )
-                for landmark in res['landmarks']
-            ]).astype(np.float32)
+            res['heatmaps'] = heatmap.gaussian_2d_batch(
+                shape=(self._heatmaps_scale*oh, self._heatmaps_scale*ow),
+                centres=self._heatmaps_scale*res['landmarks'],
+                sigma=heatmap_sigma,
+            )
             if self.data_format == 'NHWC':
                 np.transpose(res['heatmaps'], (1, 2, 0))
 
         return res
 
-    def preprocess_data(self):
+    def preprocess_data(self, num_workers=1, seed=0, shard_size=1000, resume=True):
+        """Preprocess all entries, packing them in shards of `shard_size` stems that are
+        spread across `num_workers` processes.
+
+        Every stem seeds the RNG from `seed` and a hash of the stem, so the augmented
+        output depends neither on the number of workers nor on the other stems.
+
+        Stems are recorded in a manifest in `self._output_path`. With `resume`, stems
+        whose source files and config did not change are skipped, known rejects included,
+        and only new or changed stems are packed into new shards. Outputs of stems that
+        changed or no longer exist are removed.
+        """
         # mkdir if needed
         util.mkdir(self._output_path)
 
+        manifest = Manifest(os.path.join(self._output_path, MANIFEST_FILENAME),
+                            self._config(seed))
+        if not resume:
+            manifest.clear()
+        for output in list(manifest.outputs):
+            if not os.path.exists(os.path.join(self._output_path, output)):
+                del manifest.outputs[output]
+
+        pool = None
+        if num_workers > 1:
+            pool = multiprocessing.Pool(num_workers, _init_worker, (self,))
+
+        t_start = t = time.time()
+        stage_stats = _new_stage_stats()
+        if pool is not None:
+            hashes = pool.map(_stem_hash, self._file_stems, chunksize=64)
+        else:
+            hashes = [self._stem_hash(file_stem) for file_stem in self._file_stems]
+        hashes = dict(zip(self._file_stems, hashes))
+        new_stems = [file_stem for file_stem in self._file_stems
+                     if not self._is_up_to_date(manifest, file_stem, hashes[file_stem])]
+        up_to_date_stems = set(self._file_stems).difference(new_stems)
+        num_skipped = len(up_to_date_stems)
+        # Known rejects are skipped like the saved stems, their JPEGs are not decoded
+        stage_stats['manifest'] = {
+            'accepted': len(new_stems),
+            'rejected': sum(1 for file_stem in up_to_date_stems
+                            if manifest.stems[file_stem]['rejected']),
+            'time': time.time() - t,
+        }
+
+        shard_indices = self._free_shard_indices(manifest)
+        self._remove_stale_stems(manifest, up_to_date_stems, shard_indices)
+
+        shards = [(next(shard_indices), file_stems, {s: hashes[s] for s in file_stems}, seed)
+                  for file_stems in (new_stems[start:start + shard_size]
+                                     for start in range(0, len(new_stems), shard_size))]
+        if pool is not None:
+            results = pool.imap(_preprocess_shard, shards)
+        else:
+            results = (self._preprocess_shard(*shard) for shard in shards)
+
         t = time.time()
-        for current_index in range(self._num_entries):
-            file_stem = self._file_stems[current_index]
-            jpg_path = '%s/%s.jpg' % (self._input_path, file_stem)
-            json_path = '%s/%s.json' % (self._input_path, file_stem)
-            
-            if os.path.exists(json_path):
-                with open(json_path, 'r') as f:
-                    json_data = ujson.load(f)
-                
-                    entry = {
-                        'full_image': cv.imread(jpg_path, cv.IMREAD_GRAYSCALE),
-                        'json_data': json_data
-                    }
-
-                    preprocessed_entry = self.preprocess_entry(entry)
-                    if preprocessed_entry is not None:
-                        self._save_pickle(preprocessed_entry, os.path.join(self._output_path, '%s.pickle' % file_stem))
-            
-            if current_index % 1000 == 0 and current_index != 0:
-                print('preprocessed %s entries in %s' % (current_index, (time.time()-t)))
+        num_processed = 0
+        for stem_records, output, output_stems, shard_stats in results:
+            manifest.update(stem_records, output, output_stems)
+            for stage in PIPELINE_STAGES:
+                for key in stage_stats[stage]:
+                    stage_stats[stage][key] += shard_stats[stage][key]
+            num_processed += len(stem_records)
+            print('preprocessed %s entries in %s' % (num_processed, (time.time()-t)))
+            t = time.time()
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        manifest.save()
+        self._prune_outputs(manifest)
+
+        if self._output_format == 'tfrecord':
+            records.write_index(self._output_path, {
+                output: len(output_stems) for output, output_stems in manifest.outputs.items()})
+
+        num_saved = sum(1 for record in manifest.stems.values() if not record['rejected'])
+        elapsed = time.time() - t_start
+        print('preprocessed %d entries (%d up to date, %d saved in total) in %.2fs '
+              'with %d worker(s): %.1f entries/s' % (
+                  num_processed, num_skipped, num_saved, elapsed, num_workers,
+                  num_processed / max(elapsed, 1e-9)))
+        print('%-10s %10s %10s %10s' % ('stage', 'accepted', 'rejected', 'time (s)'))
+        for stage in PIPELINE_STAGES:
+            print('%-10s %10d %10d %10.2f' % (stage, stage_stats[stage]['accepted'],
+                                              stage_stats[stage]['rejected'],
+                                              stage_stats[stage]['time']))
+
+    def _config(self, seed):
+        """Everything besides the source files that changes the preprocessed output."""
+        return {
+            'augmentation_ranges': self._augmentation_ranges,
+            'difficulty': self._difficulty,
+            'eye_image_shape': self._eye_image_shape,
+            'heatmaps_scale': self._heatmaps_scale,
+            'generate_heatmaps': self._generate_heatmaps,
+            'data_format': self.data_format,
+            'output_format': self._output_format,
+            'seed': seed,
+        }
+
+    def _stem_hash(self, file_stem):
+        return file_hash('%s/%s.json' % (self._input_path, file_stem),
+                         '%s/%s.jpg' % (self._input_path, file_stem))
+
+    def _preprocess_shard(self, shard_index, file_stems, hashes, seed):
+        """Preprocess the given stems and save them in one shard.
+
+        Returns the manifest records of the stems, the shard holding them (None for
+        pickle outputs or if all were rejected), the stems in the shard and per stage
+        statistics (see `PIPELINE_STAGES`).
+        """
+        stats = _new_stage_stats()
+        writer = None
+        if self._output_format == 'tfrecord':
+            writer = records.ShardWriter(self._output_path, shard_index)
+
+        stem_records = {}
+        output_stems = []
+        for file_stem in file_stems:
+            self._random = np.random.RandomState([seed, stem_seed(file_stem)])
+            preprocessed_entry = self._preprocess_stem(file_stem, stats)
+            if preprocessed_entry is not None:
                 t = time.time()
-    
+                if writer is not None:
+                    writer.write(preprocessed_entry)
+                else:
+                    self._save_pickle(preprocessed_entry,
+                                      os.path.join(self._output_path, '%s.pickle' % file_stem))
+                _record_stage(stats, 'save', True, t)
+                output_stems.append(file_stem)
+            stem_records[file_stem] = {'hash': hashes[file_stem],
+                                       'rejected': preprocessed_entry is None,
+                                       'output': None}
+
+        output = None
+        if writer is not None:
+            writer.close()
+            if output_stems:
+                output = os.path.basename(writer.filename)
+                for file_stem in output_stems:
+                    stem_records[file_stem]['output'] = output
+            else:
+                os.remove(writer.filename)
+        return stem_records, output, output_stems, stats
+
+    @staticmethod
+    def _free_shard_indices(manifest):
+        """Iterator over the indices, lowest first, of shards the manifest does not use now."""
+        used = set(manifest.outputs)
+        return (shard_index for shard_index in itertools.count()
+                if records.SHARD_PATTERN % shard_index not in used)
+
+    def _remove_stale_stems(self, manifest, up_to_date_stems, shard_indices):
+        """Forget the stems that changed or no longer exist.
+
+        Shards holding any of them are repacked with their other records into a new
+        shard, which is recorded before the old one is removed.
+        """
+        stale_stems = set(manifest.stems).difference(up_to_date_stems)
+        for file_stem in stale_stems:
+            del manifest.stems[file_stem]
+
+        for output, output_stems in list(manifest.outputs.items()):
+            if stale_stems.isdisjoint(output_stems):
+                continue
+            kept = [i for i, file_stem in enumerate(output_stems)
+                    if file_stem not in stale_stems]
+            del manifest.outputs[output]
+            if kept:
+                repacked = records.SHARD_PATTERN % next(shard_indices)
+                records.copy_records(os.path.join(self._output_path, output),
+                                     os.path.join(self._output_path, repacked), kept)
+                kept_stems = [output_stems[i] for i in kept]
+                manifest.outputs[repacked] = kept_stems
+                for file_stem in kept_stems:
+                    manifest.stems[file_stem]['output'] = repacked
+            manifest.save()
+            os.remove(os.path.join(self._output_path, output))
+
+    def _prune_outputs(self, manifest):
+        """Remove shards and pickles the manifest does not list, left by stems that
+        changed or no longer exist and by discarded manifests."""
+        pickles = set('%s.pickle' % file_stem for file_stem, record in manifest.stems.items()
+                      if not record['rejected'] and record['output'] is None)
+        for filename in os.listdir(self._output_path):
+            if ((filename.endswith('.tfrecord') and filename not in manifest.outputs) or
+                    (filename.endswith('.pickle') and filename not in pickles)):
+                os.remove(os.path.join(self._output_path, filename))
+
+    def _is_up_to_date(self, manifest, file_stem, stem_hash):
+        record = manifest.stems.get(file_stem)
+        if record is None or record['hash'] != stem_hash:
+            return False
+        if record['rejected']:
+            return True
+        if record['output'] is not None:
+            return record['output'] in manifest.outputs
+        return os.path.exists(os.path.join(self._output_path, '%s.pickle' % file_stem))
+
+    def _preprocess_stem(self, file_stem, stats):
+        """Preprocess a single .json/.jpg pair, returns None if it was rejected.
+
+        Entries are filtered on metadata first, so JPEGs are only decoded for
+        entries that survive the head pose filter.
+        """
+        t = time.time()
+        jpg_path = '%s/%s.jpg' % (self._input_path, file_stem)
+        json_path = '%s/%s.json' % (self._input_path, file_stem)
+        annotations = None
+        if self._annotation_index is not None or os.path.exists(json_path):
+            annotations = self._load_annotations(file_stem)
+        accepted = annotations is not None and self.is_frontal(annotations)
+        t = _record_stage(stats, 'metadata', accepted, t)
+        if not accepted:
+            return None
+
+        full_image = cv.imread(jpg_path, cv.IMREAD_GRAYSCALE)
+        t = _record_stage(stats, 'decode', full_image is not None, t)
+        if full_image is None:
+            return None
+
+        entry = {
+            'full_image': full_image,
+            'annotations': annotations
+        }
+        preprocessed_entry = self.preprocess_entry(entry)
+        _record_stage(stats, 'segment', preprocessed_entry is not None, t)
+        return preprocessed_entry
+
+    def _load_annotations(self, file_stem):
+        """Parsed annotations of a stem, from the annotation index when loaded."""
+        if self._annotation_index is not None:
+            i = self._annotation_positions[file_stem]
+            return {key: self._annotation_index[key][i] for key in ANNOTATION_KEYS}
+
+        with open('%s/%s.json' % (self._input_path, file_stem), 'r') as f:
+            return parse_annotations(ujson.load(f))
+
+    def load_annotation_index(self, index_path=None):
+        """Load (building it first if needed) the pre-parsed annotations of all stems.
+
+        The index is a single columnar .npz file, so later runs skip JSON decoding.
+        It is rebuilt when the stems or .json files in `self._input_path` changed.
+        """
+        if index_path is None:
+            index_path = os.path.join(self._input_path, ANNOTATION_INDEX_FILENAME)
+
+        json_mtimes = np.array([os.path.getmtime('%s/%s.json' % (self._input_path, file_stem))
+                                for file_stem in self._file_stems])
+
+        index = None
+        if os.path.exists(index_path):
+            index = dict(np.load(index_path))
+            # Indexes without mtimes were written before they were tracked
+            if (list(index['stems']) != self._file_stems or 'mtimes' not in index or
+                    not np.array_equal(index['mtimes'], json_mtimes)):
+                print('annotation index %s is outdated, rebuilding it' % index_path)
+                index = None
+
+        if index is None:
+            t = time.time()
+            parsed = []
+            for file_stem in self._file_stems:
+                with open('%s/%s.json' % (self._input_path, file_stem), 'r') as f:
+                    parsed.append(parse_annotations(ujson.load(f)))
+            index = {key: np.stack([p[key] for p in parsed]) for key in ANNOTATION_KEYS}
+            index['stems'] = np.array(self._file_stems)
+            index['mtimes'] = json_mtimes
+            np.savez(index_path, **index)
+            print('built annotation index %s in %.2fs' % (index_path, time.time() - t))
+
+        self._annotation_index = index
+        self._annotation_positions = {stem: i for i, stem in enumerate(self._file_stems)}
+
     def _save_pickle(self, obj, filename):
         with open(filename, 'wb') as handle:
             pickle.dump(obj, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+# Preprocessor used by the pool workers, set once per process by `_init_worker`
+_worker_preprocessor = None
+
+
+def _init_worker(preprocessor):
+    global _worker_preprocessor
+    _worker_preprocessor = preprocessor
+
+
+def _stem_hash(file_stem):
+    return _worker_preprocessor._stem_hash(file_stem)
+
+
+def _preprocess_shard(shard):
+    return _worker_preprocessor._preprocess_shard(*shard)
@@ -15,10 +15,14 @@ import cv2
 parser = argparse.ArgumentParser(description='Webcam')
 
 parser.add_argument('--model-checkpoint', type=str, default='../checkpoints/best_cnn.ckpt')
+parser.add_argument('--frozen-graph', type=str, default=None, help='Frozen graph exported by export_cnn.py, used instead of the checkpoint.')
 parser.add_argument('--model-crop-eyes', type=str, default='shape_predictor_68_face_landmarks.dat', help='download it from: https://drive.google.com/firun_prele/d/1XvAobn_6xeb8Ioa8PBnpCXZm8mgkBTiJ/view?usp=sharing')
 parser.add_argument('--eye-shape', type=int, nargs="+", default=[90, 60])
 parser.add_argument('--heatmap-scale', type=float, default=1)
 parser.add_argument('--data-format', type=str, default='NHWC')
+parser.add_argument('--detect-every', type=int, default=10, help='Run the face detector on the whole frame every N frames.')
+parser.add_argument('--detection-width', type=int, default=800, help='Width of the resized frame used for face detection.')
+parser.add_argument('--display-width', type=int, default=800, help='Width of the frame shown, and of the coordinates used by the projection.')
 parser.add_argument('-src', '--source', dest='video_source', type=int, default=0, help='Device index of the camera.')
 parser.add_argument('-num-w', '--num-workers', dest='num_workers', type=int, default=2, help='Number of workers.')
 parser.add_argument('-q-size', '--queue-size', dest='queue_size', type=int, default=1, help='Size of the queue.')
@@ -12,9 +12,12 @@ import tensorflow as tf
 
 from data_sources.img_data_source import ImgDataSource
 from preprocessing.img_preprocessor import ImgPreprocessor
-from models.cnn import CNN
+from models.cnn import CNN, load_model_config
+from models.frozen_cnn import FrozenCNN
 
 import util.util as util
+from util.face_tracker import FaceTracker, shape_to_coords
+from util.gaze import landmark_confidence
 from webcam.webcam_stream import WebcamVideoStream
 
 
@@ -31,27 +34,16 @@ class Model:
         # get file:shape_predictor_68_face_landmarks.dat from
         # link: https://drive.google.com/firun_prele/d/1XvAobn_6xeb8Ioa8PBnpCXZm8mgkBTiJ/view?usp=sharing
         self.landmark_predictor = dlib.shape_predictor(args.model_crop_eyes)
+        # Between detections the face is searched around its previous landmarks
+        self.face_tracker = FaceTracker(self.face_detector, self.landmark_predictor,
+                                        detect_every=args.detect_every,
+                                        detection_width=args.detection_width)
 
         self.datasource, self.preprocessor, self.sess, self.model = self.setup()
         self.gaze_history = []
         self.gaze_history_max_len = 10
 
 
-    # Function for creating landmark coordinate list
-    def land2coords(self, landmarks, dtype="int"):
-        # initialize the list of tuples
-        # (x, y)-coordinates
-        coords = np.zeros((68, 2), dtype=dtype)
-
-        # loop over the eyes landmarks and convert them
-        # to a 2-tuple of (a, b)-coordinates
-        for i in range(36, 48):
-            coords[i] = (landmarks.part(i).x, landmarks.part(i).y)
-
-        # return the list of (a, b)-coordinates
-        return coords
-
-
     def get_eye_info(self, landmarks, frame_gray):
         # Segment eyes
         oh, ow = tuple(self.args.eye_shape)
@@ -113,13 +105,10 @@ class Model:
         return eyes
 
 
-    def estimate_gaze(self, eye, heatmaps, face_landmarks, eye_landmarks, eye_radius, face, frame_rgb):
+    def estimate_gaze(self, eye, heatmaps_amax, face_landmarks, eye_landmarks, eye_radius, face, frame_rgb):
         # Gaze estimation
         landmarks = face_landmarks
-        heatmaps_amax = np.amax(heatmaps.reshape(-1, 18), axis=0)
-        can_use_eye = np.all(heatmaps_amax > 0.7)
-        can_use_eyelid = np.all(heatmaps_amax[0:8] > 0.75)
-        can_use_iris = np.all(heatmaps_amax[8:16] > 0.8)
+        can_use_eye, can_use_eyelid, can_use_iris = landmark_confidence(heatmaps_amax)
         bgr = frame_rgb
         # bgr = cv2.flip(bgr, flipCode=1)
         eye_image = eye['image']
@@ -221,14 +210,13 @@ class Model:
             return bgr, None
 
 
-    def detect_eye_landmarks(self, image_np):
-        preprocessed_image = self.preprocessor.preprocess_entry(image_np)
-        self.datasource.image = preprocessed_image
-        self.datasource.run_single(self.sess)
-        self.model.eval(self.sess)
-        input_image, eye_landmarks, eye_heatmaps, eye_radius = self.model.run_model(self.sess)
-        assert np.all(input_image == preprocessed_image), (input_image, preprocessed_image)
-        return eye_landmarks, eye_heatmaps, eye_radius
+    def detect_eye_landmarks(self, images):
+        # Both eyes in a single forward pass
+        preprocessed_images = np.stack([self.preprocessor.preprocess_entry(image)
+                                        for image in images])
+        if self.args.frozen_graph:
+            return self.model.predict_eyes(preprocessed_images)
+        return self.model.predict_eyes(self.sess, self.datasource.feed_dict(preprocessed_images))
 
 
     def setup(self):
@@ -237,11 +225,16 @@ class Model:
         data_format = self.args.data_format
         shape = tuple(self.args.eye_shape)
         preprocessor = ImgPreprocessor(data_format)
+        if self.args.frozen_graph:
+            # Nothing to rebuild or restore
+            model = FrozenCNN(self.args.frozen_graph)
+            return None, preprocessor, model.sess, model
         datasource = ImgDataSource(shape=shape,
                                    data_format=data_format)
         # Get model
         model = CNN(datasource.tensors, datasource.x_shape, None,
-                    data_format=data_format, predict_only=True)
+                    data_format=data_format, predict_only=True,
+                    model_config=load_model_config(self.args.model_checkpoint))
 
         # Start session
         saver = tf.train.Saver()
@@ -263,35 +256,41 @@ class Model:
 
         frame = self.video_capture.read()
 
-        # resizing frame
-        frame = imutils.resize(frame, width=800)
+        # Faces are detected on a downscaled frame, landmarks and eye crops use the
+        # camera resolution. Results are returned in the coordinates of a frame of
+        # `display_width`, which the projection geometry expects
+        display_scale = self.args.display_width / frame.shape[1]
 
         frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         # grayscale conversion of image because it is computationally efficient
         # to perform operations on single channeled (grayscale) image
         frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
-        # detecting faces
-        face_boundaries = self.face_detector(frame_gray, 0)
+        # detecting faces and predicting their landmarks
+        faces = self.face_tracker.update(frame_gray)
         # if there's no face do nothing
-        if len(face_boundaries) < 1:
+        if len(faces) < 1:
             return result
 
-        face = face_boundaries[0]
-        # for face in face_boundaries:
-        # Let's predict the landmarks
-        landmarks = self.landmark_predictor(frame_gray, face)
+        face, landmarks = faces[0]
         # converting co-ordinates to NumPy array
-        landmarks = self.land2coords(landmarks)
+        landmarks = shape_to_coords(landmarks)
 
         eyes = self.get_eye_info(landmarks, frame_gray)
         face = (face.left(), face.top(), face.right(), face.bottom())
-        for eye in eyes:
-            eye_landmarks, heatmaps, eye_radius = self.detect_eye_landmarks(eye['image'])
-            eye_landmarks = eye_landmarks.reshape(18, 2)
-            bgr, gaze_info = self.estimate_gaze(eye, heatmaps, landmarks, eye_landmarks, eye_radius, face, frame)
+        if not eyes:
+            return result
+        outputs = self.detect_eye_landmarks([eye['image'] for eye in eyes])
+        for i, eye in enumerate(eyes):
+            eye_landmarks = outputs['landmarks'][i].reshape(18, 2)
+            bgr, gaze_info = self.estimate_gaze(eye, outputs['heatmaps_amax'][i], landmarks, eye_landmarks,
+                                                outputs['radius'][i:i + 1], face, frame)
+            if gaze_info is not None:
+                angles, eyeball_centre, eyeball_radius = gaze_info
+                gaze_info = (angles, eyeball_centre * display_scale, eyeball_radius * display_scale)
             result.append(gaze_info)
 
+        bgr = imutils.resize(bgr, width=self.args.display_width)
         return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB), result
 
 
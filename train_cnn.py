@@ -2,11 +2,16 @@ from __future__ import division, print_function, absolute_import
 
 import os
 import glob
+import functools
 import util.util as util
+import util.records as records
 
 from data_sources.data_source import DataSource
 from models.cnn import CNN
 from learning.trainer import Trainer
+from learning.evaluator import BackgroundEvaluator
+from learning.data_parallel import DataParallelTrainer
+from preprocessing.augmentation import Augmenter
 
 
 import argparse
@@ -21,30 +26,160 @@ parser.add_argument('--data-format', type=str, default='NCHW')
 
 parser.add_argument('--eye-shape', type=int, nargs="+", default=[60, 90])
 parser.add_argument('--heatmap-scale', type=float, default=1)
+parser.add_argument('--render-heatmaps', action='store_true',
+                    help='Render heatmaps from landmarks (data preprocessed with --no-heatmaps).')
+parser.add_argument('--heatmap-sigma', type=float, default=None,
+                    help='Overrides the sigma saved with each sample when rendering heatmaps.')
+parser.add_argument('--online-augmentation', action='store_true',
+                    help='Augment while training (requires --render-heatmaps).')
+parser.add_argument('--augmentation-calls', type=int, default=8,
+                    help='Number of batches augmented in parallel.')
+parser.add_argument('--augmentation-workers', type=int, default=0,
+                    help='Augment in a pool with this many processes instead of in threads.')
+parser.add_argument('--curriculum-steps', type=int, default=None,
+                    help='Steps to increase augmentation difficulty from 0 to 1.')
+parser.add_argument('--num-parallel-calls', type=int, default=None,
+                    help='Samples decoded in parallel (default: autotune).')
+parser.add_argument('--num-parallel-reads', type=int, default=None,
+                    help='TFRecord shards read in parallel (default: number of CPUs).')
+parser.add_argument('--prefetch-batches', type=int, default=None,
+                    help='Batches prefetched for the trainer (default: autotune).')
+parser.add_argument('--summary-steps', type=int, default=100,
+                    help='Write the TensorBoard summaries every this many steps.')
+parser.add_argument('--log-steps', type=int, default=100,
+                    help='Log the averaged losses and steps/s every this many steps.')
+parser.add_argument('--checkpoint-steps', type=int, default=1000,
+                    help='Save a resumable checkpoint every this many steps.')
+parser.add_argument('--checkpoint-secs', type=int, default=600,
+                    help='Save a resumable checkpoint at least every this many seconds.')
+parser.add_argument('--keep-checkpoints', type=int, default=3,
+                    help='Number of resumable checkpoints kept.')
+parser.add_argument('--no-resume', action='store_true',
+                    help='Start from scratch instead of resuming the latest checkpoint.')
+parser.add_argument('--model-config', type=str, default='default',
+                    help='Hourglass preset: default, fast or fastest (see models/cnn.py).')
+parser.add_argument('--precision', type=str, default='float32',
+                    help='Compute precision of the hourglass: float32, float16 or bfloat16.')
+parser.add_argument('--loss-scale', type=float, default=None,
+                    help='Static loss scale (default: 128 for float16, 1 otherwise).')
+parser.add_argument('--accumulation-steps', type=int, default=1,
+                    help='Sum the gradients of this many batches per optimizer step.')
+parser.add_argument('--data-parallel-workers', type=int, default=1,
+                    help='Train with this many synchronous data-parallel processes.')
+parser.add_argument('--background-eval', action='store_true',
+                    help='Evaluate checkpoints in a separate process instead of pausing training.')
+parser.add_argument('--eval-threads', type=int, default=0,
+                    help='TensorFlow threads of the background evaluator (0: TensorFlow default).')
+parser.add_argument('--mmap', action='store_true',
+                    help='Paths are directories of memory-mapped arrays (see convert_pickles.py).')
 
 
-def main(args):
+# Learning schedule shared by training and the background evaluator
+LEARNING_SCHEDULE = [
+    {
+        'loss_terms_to_optimize': {
+            'heatmaps_mse': ['hourglass'],
+            'radius_mse': ['radius'],
+        },
+        'learning_rate': 1e-3,
+    },
+]
+
+
+def get_datasource(args, train=True, shard_index=0, num_shards=1):
+    # Get online augmentation
+    augmenter = None
+    if train and args.online_augmentation:
+        augmenter = Augmenter(data_format=args.data_format,
+                              num_parallel_calls=args.augmentation_calls,
+                              num_workers=args.augmentation_workers,
+                              curriculum_steps=args.curriculum_steps,
+                              batches_per_step=args.accumulation_steps)
+
     # Get dataset
-    train_files = glob.glob(os.path.join(args.train_path, '*.pickle'))
-    eval_files = glob.glob(os.path.join(args.eval_path, '*.pickle'))
+    if args.mmap:
+        train_files, eval_files = args.train_path, args.eval_path
+    else:
+        train_files = records.list_files(args.train_path)
+        eval_files = records.list_files(args.eval_path)
+    if not train:
+        train_files = None
     datasource = DataSource(train_files, eval_files, shape=tuple(args.eye_shape),
                             batch_size=args.batch_size,
-                            data_format=args.data_format, heatmap_scale=args.heatmap_scale)
+                            data_format=args.data_format, heatmap_scale=args.heatmap_scale,
+                            mmap=args.mmap, render_heatmaps=args.render_heatmaps,
+                            heatmap_sigma=args.heatmap_sigma, augmenter=augmenter,
+                            num_parallel_calls=args.num_parallel_calls,
+                            num_parallel_reads=args.num_parallel_reads,
+                            prefetch_batches=args.prefetch_batches,
+                            shard_index=shard_index, num_shards=num_shards)
+    return datasource
+
+
+def build_eval_model(args):
+    """Build the eval datasource and model, used by the background evaluator."""
+    datasource = get_datasource(args, train=False)
+    model = CNN(datasource.tensors, datasource.x_shape, LEARNING_SCHEDULE,
+                precision=args.precision, loss_scale=args.loss_scale,
+                model_config=args.model_config)
+    return model, datasource
+
+
+def get_model(args, datasource, data_parallel=False):
+    """Build the training model, the same in single process and data-parallel training."""
+    return CNN(datasource.tensors, datasource.x_shape, LEARNING_SCHEDULE,
+               accumulation_steps=args.accumulation_steps, data_parallel=data_parallel,
+               precision=args.precision, loss_scale=args.loss_scale,
+               model_config=args.model_config)
+
+
+def build_data_parallel_model(args, shard_index, num_shards):
+    """Build the datasource and model of one data-parallel worker."""
+    datasource = get_datasource(args, shard_index=shard_index, num_shards=num_shards)
+    return get_model(args, datasource, data_parallel=True), datasource
+
+
+def check_data_parallel_args(args):
+    if args.accumulation_steps > 1:
+        parser.error('--accumulation-steps is not supported with --data-parallel-workers')
+    if args.background_eval:
+        parser.error('--background-eval is not supported with --data-parallel-workers')
+
+
+def main(args):
+    if args.data_parallel_workers > 1:
+        check_data_parallel_args(args)
+        trainer = DataParallelTrainer(functools.partial(build_data_parallel_model, args),
+                                      args.data_parallel_workers, eval_steps=args.eval_steps,
+                                      log_steps=args.log_steps,
+                                      summary_steps=args.summary_steps,
+                                      checkpoint_steps=args.checkpoint_steps,
+                                      checkpoint_secs=args.checkpoint_secs,
+                                      checkpoints_to_keep=args.keep_checkpoints,
+                                      resume=not args.no_resume)
+        return trainer.run_training(args.steps)
+
+    # Get dataset
+    datasource = get_datasource(args)
 
     # Get model
-    learning_schedule=[
-        {
-            'loss_terms_to_optimize': {
-                'heatmaps_mse': ['hourglass'],
-                'radius_mse': ['radius'],
-            },
-            'learning_rate': 1e-3,
-        },
-    ]
-    model = CNN(datasource.tensors, datasource.x_shape, learning_schedule)
+    model = get_model(args, datasource)
+
+    # Evaluate in another process while training continues
+    background_evaluator = None
+    if args.background_eval:
+        background_evaluator = BackgroundEvaluator(functools.partial(build_eval_model, args),
+                                                   num_threads=args.eval_threads,
+                                                   resume=not args.no_resume)
     
     # Get trainer
-    trainer = Trainer(model, eval_steps=args.eval_steps)
+    trainer = Trainer(model, eval_steps=args.eval_steps,
+                      background_evaluator=background_evaluator,
+                      summary_steps=args.summary_steps, log_steps=args.log_steps,
+                      checkpoint_steps=args.checkpoint_steps,
+                      checkpoint_secs=args.checkpoint_secs,
+                      checkpoints_to_keep=args.keep_checkpoints,
+                      resume=not args.no_resume)
 
     # Train for 10000 steps
     return trainer.run_training(datasource, args.steps)
@@ -0,0 +1,22 @@
+"""Utility methods for datasets stored as contiguous memory-mapped .npy arrays."""
+import os
+import numpy as np
+
+
+def _array_path(path, key):
+    return os.path.join(path, '%s.npy' % key)
+
+
+def create_arrays(path, keys, num_entries, example):
+    """Create writable memory-mapped arrays with room for `num_entries` like `example`."""
+    return {
+        key: np.lib.format.open_memmap(
+            _array_path(path, key), mode='w+', dtype=np.float32,
+            shape=(num_entries,) + np.shape(example[key]))
+        for key in keys
+    }
+
+
+def open_arrays(path, keys):
+    """Open the arrays read-only, pages are shared through the OS page cache."""
+    return {key: np.load(_array_path(path, key), mmap_mode='r') for key in keys}
@@ -0,0 +1,111 @@
+"""Track faces between frames so the HOG face detector rarely runs on the whole frame."""
+import cv2 as cv
+import dlib
+import numpy as np
+
+
+def shape_to_coords(shape, dtype=int):
+    """The 68 (x, y) landmarks of a `dlib.full_object_detection` as an array."""
+    return np.array([(shape.part(i).x, shape.part(i).y) for i in range(shape.num_parts)],
+                    dtype=dtype)
+
+
+def rect_iou(a, b):
+    """Intersection over union of two `dlib.rectangle`."""
+    width = min(a.right(), b.right()) - max(a.left(), b.left()) + 1
+    height = min(a.bottom(), b.bottom()) - max(a.top(), b.top()) + 1
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    return intersection / float(a.area() + b.area() - intersection)
+
+
+class FaceTracker(object):
+    """Face rectangles and 68-point landmarks of a video, frame by frame.
+
+    The detector runs on the whole frame every `detect_every` frames, when there is no
+    face to track or when a tracked face is lost. In between, every face is searched only
+    in a region around its previous landmarks, extended by `margin` times their size on
+    each side, and is kept while the detector score there is above `min_score`. The
+    detection overlapping the previous rectangle the most is used, and tracks that end up
+    on the same face are merged. New faces are found at the next full detection.
+
+    With `detection_width` the detector runs on frames resized to that width (faces must
+    be about 80 pixels wide there, narrower frames are upscaled), while the landmarks are
+    predicted on the given frame, so eye crops keep the camera resolution. Rectangles and
+    landmarks are always in the coordinates of the given frame.
+    """
+    def __init__(self, face_detector, landmark_predictor, detect_every=10, margin=0.5,
+                 min_score=0.0, detection_width=None):
+        self.face_detector = face_detector
+        self.landmark_predictor = landmark_predictor
+        self.detect_every = detect_every
+        self.margin = margin
+        self.min_score = min_score
+        self.detection_width = detection_width
+        self.num_detections = 0
+
+        self._frames_since_detection = 0
+        self._faces = []
+        self._faces_coords = []
+
+    def update(self, frame_gray):
+        """List of `(dlib.rectangle, dlib.full_object_detection)` of the faces of a frame."""
+        scale = 1.0
+        if self.detection_width and frame_gray.shape[1] != self.detection_width:
+            scale = self.detection_width / frame_gray.shape[1]
+
+        faces = None
+        if self._faces_coords and self._frames_since_detection < self.detect_every:
+            faces = self._track(frame_gray, scale)
+        if faces is None:
+            faces = self._detect(frame_gray, scale)
+            self._frames_since_detection = 0
+            self.num_detections += 1
+        self._frames_since_detection += 1
+
+        shapes = [self.landmark_predictor(frame_gray, face) for face in faces]
+        self._faces = faces
+        self._faces_coords = [shape_to_coords(shape) for shape in shapes]
+        return list(zip(faces, shapes))
+
+    def _run_detector(self, image, scale, threshold=0.0):
+        """Detections and scores in `image` resized by `scale`, in `image` coordinates."""
+        if scale != 1.0:
+            image = cv.resize(image, (0, 0), fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+        rects, scores, _ = self.face_detector.run(image, 0, threshold)
+        rects = [dlib.rectangle(int(round(r.left() / scale)), int(round(r.top() / scale)),
+                                int(round(r.right() / scale)), int(round(r.bottom() / scale)))
+                 for r in rects]
+        return rects, scores
+
+    def _detect(self, frame_gray, scale=1.0):
+        return self._run_detector(frame_gray, scale)[0]
+
+    def _track(self, frame_gray, scale=1.0):
+        """Faces found around the previous landmarks, None if any of them was lost."""
+        height, width = frame_gray.shape[:2]
+        faces = []
+        for previous, coords in zip(self._faces, self._faces_coords):
+            (x0, y0), (x1, y1) = coords.min(axis=0), coords.max(axis=0)
+            margin_x, margin_y = self.margin * (x1 - x0), self.margin * (y1 - y0)
+            left, top = max(0, int(x0 - margin_x)), max(0, int(y0 - margin_y))
+            right = min(width, int(x1 + margin_x) + 1)
+            bottom = min(height, int(y1 + margin_y) + 1)
+            if right <= left or bottom <= top:
+                return None
+
+            roi = np.ascontiguousarray(frame_gray[top:bottom, left:right])
+            rects, _ = self._run_detector(roi, scale, self.min_score)
+            rects = [dlib.rectangle(r.left() + left, r.top() + top,
+                                    r.right() + left, r.bottom() + top) for r in rects]
+            # The highest score in the region can belong to a neighbouring face
+            ious = [rect_iou(rect, previous) for rect in rects]
+            if not ious or max(ious) == 0.0:
+                return None
+            face = rects[int(np.argmax(ious))]
+            # Two tracks snapped to the same face, keep the first one
+            if any(rect_iou(face, other) > 0.5 for other in faces):
+                continue
+            faces.append(face)
+        return faces
@@ -4,6 +4,26 @@ import numpy as np
 import tensorflow as tf
 
 
+# Heatmap peaks all the landmarks, the eyelid and the iris landmarks of an eye need for
+# gaze estimation
+EYE_CONFIDENCE = 0.7
+EYELID_CONFIDENCE = 0.75
+IRIS_CONFIDENCE = 0.8
+
+
+def landmark_confidence(heatmaps_amax):
+    """Whether the eye, its eyelid and its iris landmarks can be used for gaze estimation.
+
+    `heatmaps_amax` holds the heatmap peaks of the 18 landmarks of an eye, or of a batch
+    of eyes along the first axis.
+    """
+    heatmaps_amax = np.asarray(heatmaps_amax)
+    can_use_eye = np.all(heatmaps_amax > EYE_CONFIDENCE, axis=-1)
+    can_use_eyelid = np.all(heatmaps_amax[..., 0:8] > EYELID_CONFIDENCE, axis=-1)
+    can_use_iris = np.all(heatmaps_amax[..., 8:16] > IRIS_CONFIDENCE, axis=-1)
+    return can_use_eye, can_use_eyelid, can_use_iris
+
+
 def pitchyaw_to_vector(pitchyaws):
     r"""Convert given yaw (:math:`\theta`) and pitch (:math:`\phi`) angles to unit gaze vectors.
 
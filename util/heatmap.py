@@ -1,5 +1,6 @@
 """Utility methods for generating and visualizing heatmaps."""
 import numpy as np
+import tensorflow as tf
 
 
 def gaussian_2d(shape, centre, sigma=1.0):
@@ -9,3 +10,66 @@ def gaussian_2d(shape, centre, sigma=1.0):
     alpha = -0.5 / (sigma**2)
     heatmap = np.exp(alpha * ((xs - centre[0])**2 + (ys - centre[1])**2))
     return heatmap
+
+
+_coordinate_grids = {}
+
+
+def _coordinate_grid(shape):
+    """Pixel centre coordinates (ys, xs) for heatmaps of `shape`, cached per shape."""
+    key = tuple(shape)
+    if key not in _coordinate_grids:
+        _coordinate_grids[key] = (
+            np.arange(0.5, shape[0] + 0.5, step=1.0, dtype=np.float32),
+            np.arange(0.5, shape[1] + 0.5, step=1.0, dtype=np.float32),
+        )
+    return _coordinate_grids[key]
+
+
+def gaussian_2d_batch(shape, centres, sigma=1.0, out=None):
+    r"""Generate heatmaps with one 2D gaussian per centre in a single broadcasted call.
+
+    The gaussian is separable, so it is computed as the outer product of two 1D
+    gaussians: :math:`h + w` exponentials per heatmap instead of :math:`h\times w`.
+
+    Args:
+        shape: (height, width) of the heatmaps.
+        centres: array :math:`(\ldots\times 2)` of (x, y) coordinates, e.g.
+            :math:`(n\times l\times 2)` for `l` landmarks of `n` samples.
+        sigma: standard deviation, scalar or broadcastable to `centres.shape[:-1]`.
+        out: optional preallocated float32 array of shape `centres.shape[:-1] + shape`.
+
+    Returns:
+        float32 :obj:`numpy.array` of shape `centres.shape[:-1] + (height, width)`.
+    """
+    centres = np.asarray(centres, dtype=np.float32)
+    ys, xs = _coordinate_grid(shape)
+    alpha = -0.5 / np.square(np.asarray(sigma, dtype=np.float32))
+    alpha = np.broadcast_to(alpha, centres.shape[:-1])[..., np.newaxis]
+    gx = np.exp(alpha * np.square(xs - centres[..., 0:1]))  # ... x W
+    gy = np.exp(alpha * np.square(ys - centres[..., 1:2]))  # ... x H
+    if out is None:
+        out = np.empty(centres.shape[:-1] + (len(ys), len(xs)), dtype=np.float32)
+    np.multiply(gy[..., :, np.newaxis], gx[..., np.newaxis, :], out=out)
+    return out
+
+
+def tensorflow_gaussian_2d(shape, centres, sigma):
+    r"""Tensorflow method to render one 2D gaussian per landmark for a batch.
+
+    Args:
+        shape: (height, width) of the heatmaps.
+        centres: :math:`(n\times l\times 2)` tensor with (x, y) landmark coordinates.
+        sigma: :math:`(n)` tensor with one standard deviation per sample.
+
+    Returns:
+        :math:`(n\times l\times h\times w)` float32 tensor, the in-graph equivalent
+        of `gaussian_2d_batch`.
+    """
+    with tf.name_scope('gaussian_2d'):
+        ys, xs = (tf.constant(grid) for grid in _coordinate_grid(shape))
+        alpha = tf.reshape(-0.5 / tf.square(sigma), [-1, 1, 1])
+        # exp(a*(dx^2 + dy^2)) == exp(a*dx^2) * exp(a*dy^2), so render separably
+        gx = tf.exp(alpha * tf.square(xs - tf.expand_dims(centres[:, :, 0], -1)))  # N x L x W
+        gy = tf.exp(alpha * tf.square(ys - tf.expand_dims(centres[:, :, 1], -1)))  # N x L x H
+        return tf.expand_dims(gy, -1) * tf.expand_dims(gx, -2)
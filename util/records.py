@@ -0,0 +1,97 @@
+"""Utility methods for reading and writing sharded TFRecord datasets.
+
+Each shard stores one `tf.train.Example` per sample with every array saved as raw
+float32 bytes, so `tf.data` can decode them natively without a `tf.py_func`.
+"""
+import os
+import glob
+import ujson
+import numpy as np
+import tensorflow as tf
+
+SHARD_PATTERN = 'shard-%05d.tfrecord'
+INDEX_FILENAME = 'index.json'
+RECORD_KEYS = ('eye', 'heatmaps', 'landmarks', 'radius', 'gaze', 'heatmap_sigma')
+
+
+def _bytes_feature(array):
+    value = np.ascontiguousarray(array, dtype=np.float32).tobytes()
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def serialize_entry(entry):
+    """Serialize a preprocessed entry as a `tf.train.Example` string."""
+    feature = {key: _bytes_feature(entry[key]) for key in RECORD_KEYS if key in entry}
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+
+def parse_entry(serialized, keys):
+    """Tensorflow method to decode the flat float32 arrays of a serialized entry."""
+    features = tf.parse_single_example(
+        serialized, {key: tf.FixedLenFeature([], tf.string) for key in keys})
+    return {key: tf.decode_raw(features[key], tf.float32) for key in keys}
+
+
+class ShardWriter(object):
+    """Write serialized entries to a single TFRecord shard."""
+    def __init__(self, output_path, shard_index):
+        self.filename = os.path.join(output_path, SHARD_PATTERN % shard_index)
+        self.num_records = 0
+        self._writer = tf.python_io.TFRecordWriter(self.filename)
+
+    def write(self, entry):
+        self._writer.write(serialize_entry(entry))
+        self.num_records += 1
+
+    def close(self):
+        self._writer.close()
+
+
+def copy_records(source, destination, indices):
+    """Copy the records at `indices` of the `source` shard to a new `destination` shard.
+
+    Serialized records are copied as they are, without decoding them.
+    """
+    indices = set(indices)
+    writer = tf.python_io.TFRecordWriter(destination)
+    for i, serialized in enumerate(tf.python_io.tf_record_iterator(source)):
+        if i in indices:
+            writer.write(serialized)
+    writer.close()
+
+
+def write_index(output_path, num_records):
+    """Save the number of records per shard, `num_records` maps shard basenames to counts."""
+    with open(os.path.join(output_path, INDEX_FILENAME), 'w') as f:
+        ujson.dump(num_records, f)
+
+
+def count_records(files):
+    """Number of records in the given shards, read from the index when available."""
+    indexes = {}
+    total = 0
+    for filename in files:
+        dirname = os.path.dirname(filename)
+        if dirname not in indexes:
+            index_path = os.path.join(dirname, INDEX_FILENAME)
+            indexes[dirname] = {}
+            if os.path.exists(index_path):
+                with open(index_path, 'r') as f:
+                    indexes[dirname] = ujson.load(f)
+        num_records = indexes[dirname].get(os.path.basename(filename))
+        if num_records is None:
+            num_records = sum(1 for _ in tf.python_io.tf_record_iterator(filename))
+        total += num_records
+    return total
+
+
+def list_files(path):
+    """List dataset files in `path`, preferring TFRecord shards over per-sample pickles."""
+    files = sorted(glob.glob(os.path.join(path, '*.tfrecord')))
+    if not files:
+        files = glob.glob(os.path.join(path, '*.pickle'))
+    return files
+
+
+def is_tfrecord(files):
+    return len(files) > 0 and all(f.endswith('.tfrecord') for f in files)